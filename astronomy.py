@@ -0,0 +1,151 @@
+from datetime import date, datetime
+from zoneinfo import ZoneInfo
+
+import numpy as np
+
+# Sun altitude below the horizon at fajr and isha, in degrees. An isha
+# given as a string is a fixed number of minutes after maghrib.
+METHODS = {
+    "MWL": {"fajr": 18, "isha": 17},
+    "ISNA": {"fajr": 15, "isha": 15},
+    "Egypt": {"fajr": 19.5, "isha": 17.5},
+    "Makkah": {"fajr": 18.5, "isha": "90 min"},
+    "Karachi": {"fajr": 18, "isha": 18},
+    "Diyanet": {"fajr": 18, "isha": 17},
+}
+# Shadow length factor at asr: 1 is Shafi'i, Maliki and Hanbali, 2 is Hanafi.
+ASR_SHAFII = 1
+ASR_HANAFI = 2
+# Apparent sunrise and sunset, refraction and the sun's radius included.
+SUNRISE_ANGLE = 0.833
+# Julian day of 1970-01-01 00:00 UT.
+UNIX_EPOCH_JD = 2440587.5
+
+
+def julian_days(days):
+    """Julian day at 00:00 UT for an array of ordinal dates."""
+    return UNIX_EPOCH_JD + days - date(1970, 1, 1).toordinal()
+
+
+def sun_position(jd):
+    """Return declination (degrees) and equation of time (hours) per day."""
+    d = jd - 2451545.0
+    g = np.radians(357.529 + 0.98560028 * d)
+    q = 280.459 + 0.98564736 * d
+    lon = np.radians(q + 1.915 * np.sin(g) + 0.020 * np.sin(2 * g))
+    e = np.radians(23.439 - 0.00000036 * d)
+
+    ra = np.degrees(np.arctan2(np.cos(e) * np.sin(lon), np.cos(lon))) / 15
+    declination = np.degrees(np.arcsin(np.sin(e) * np.sin(lon)))
+    equation = q / 15 - ra
+    equation = (equation + 12) % 24 - 12
+    return declination, equation
+
+
+def hour_angle(altitude, latitude, declination):
+    """
+    Hours between solar noon and the sun reaching altitude.
+
+    NaN where the sun never gets there that day, e.g. no astronomical
+    night at high latitudes in summer.
+    """
+    lat = np.radians(latitude)
+    dec = np.radians(declination)
+    cos_h = (np.sin(np.radians(altitude)) - np.sin(lat) * np.sin(dec)) / (
+        np.cos(lat) * np.cos(dec)
+    )
+    with np.errstate(invalid="ignore"):
+        return np.degrees(np.arccos(cos_h)) / 15
+
+
+def night_limited(time, bound, angle, night, direction):
+    """
+    Apply the angle-based high latitude rule.
+
+    fajr may not come earlier than angle/60 of the night before sunrise,
+    nor isha later than that after sunset; it takes that limit where
+    the sun does not reach the angle at all.
+    """
+    limit = bound + direction * angle / 60 * night
+    beyond = np.isnan(time) | (direction * (time - limit) > 0)
+    return np.where(beyond, limit, time)
+
+
+def utc_offsets(days, timezone):
+    """Offset from UTC in hours at local noon of every day."""
+    zone = ZoneInfo(timezone)
+    return np.array(
+        [
+            datetime.combine(date.fromordinal(int(day)), datetime.min.time())
+            .replace(hour=12, tzinfo=zone)
+            .utcoffset()
+            .total_seconds()
+            / 3600
+            for day in days
+        ]
+    )
+
+
+def prayer_times(start, end, latitude, longitude, timezone, method="Diyanet",
+                 asr_factor=ASR_SHAFII):
+    """
+    Compute the timetable of every day between start and end, both included.
+
+    Returns (days, times): days is a list of dates, times maps fajr,
+    sunrise, dhuhr, asr, maghrib and isha to arrays of local times as
+    hours after that day's midnight (past 24 is the next day), one entry
+    per day. Days without sunrise or sunset (polar day and night) are NaN.
+    """
+    angles = METHODS[method]
+    days = np.arange(start.toordinal(), end.toordinal() + 1)
+    offsets = utc_offsets(days, timezone)
+    # Solar noon is close enough to evaluate the sun's position once a day.
+    declination, equation = sun_position(julian_days(days) + 0.5 - longitude / 360)
+
+    dhuhr = 12 + offsets - longitude / 15 - equation
+    sun = hour_angle(-SUNRISE_ANGLE, latitude, declination)
+    shadow = asr_factor + np.tan(np.radians(np.abs(latitude - declination)))
+    asr = hour_angle(np.degrees(np.arctan(1 / shadow)), latitude, declination)
+    maghrib = dhuhr + sun
+
+    sunrise = dhuhr - sun
+    night = 24 - (maghrib - sunrise)
+
+    if isinstance(angles["isha"], str):
+        isha = maghrib + float(angles["isha"].split()[0]) / 60
+    else:
+        isha = night_limited(
+            dhuhr + hour_angle(-angles["isha"], latitude, declination),
+            maghrib, angles["isha"], night, 1,
+        )
+    fajr = night_limited(
+        dhuhr - hour_angle(-angles["fajr"], latitude, declination),
+        sunrise, angles["fajr"], night, -1,
+    )
+
+    times = {
+        "fajr": fajr,
+        "sunrise": sunrise,
+        "dhuhr": dhuhr,
+        "asr": dhuhr + asr,
+        "maghrib": maghrib,
+        "isha": isha,
+    }
+    return [date.fromordinal(int(day)) for day in days], times
+
+
+def format_times(hours):
+    """
+    Round hour arrays to minutes and split them into (day offset, "HH:MM").
+
+    Times past midnight get offset 1, before it -1; NaN gives None.
+    """
+    formatted = []
+    for value in np.asarray(hours).tolist():
+        if value != value:
+            formatted.append(None)
+            continue
+        days, minutes = divmod(round(value * 60), 24 * 60)
+        formatted.append((days, f"{minutes // 60:02d}:{minutes % 60:02d}"))
+    return formatted
+
@@ -0,0 +1,44 @@
+"""
+Status.list() of 100k praying statuses, the records screen's load.
+
+Cached results and identity-mapped rows are dropped before every run,
+so each one queries and hydrates every row again.
+"""
+from datetime import date, timedelta
+
+from common import best_of, use_tree
+
+use_tree()
+
+from config import PRAYER_TIMES  # noqa: E402
+from models import Status  # noqa: E402
+from storage import SQLiteDB  # noqa: E402
+
+ROWS = 100000
+
+
+def main():
+    start = date(1980, 1, 1)
+    Status.create_bulk(
+        chunks=[
+            dict(
+                time_name=PRAYER_TIMES[index % 6],
+                date=start + timedelta(days=index // 6),
+                is_prayed=index % 2,
+            )
+            for index in range(ROWS)
+        ]
+    )
+
+    # Trees before the query cache have nothing to invalidate.
+    invalidate = getattr(SQLiteDB, "invalidate", lambda: None)
+
+    def load():
+        invalidate()
+        Status.list()
+
+    print(f"Status.list() of {ROWS} rows: {best_of(load) * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Time to the first timetable with one hanging and one failing provider.
+
+Three local stand-in servers serve the Heroku vakitler payload with
+injected latency: the first never answers within the read timeout, the
+second fails with 503 after a second, the third answers in 0.3 s. The
+sequential fallback the app used before is timed against the
+ProviderOrchestrator, whose later calls profit from its ranking.
+"""
+import json
+import threading
+import time
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+from common import use_tree
+
+use_tree()
+
+from providers import Heroku, ProviderError, ProviderOrchestrator, Transport  # noqa: E402
+
+TIMEOUT = (2, 4)
+ROUNDS = 3
+
+
+def vakitler():
+    return [
+        {
+            "MiladiTarihKisa": (date.today() + timedelta(days=day)).strftime("%d.%m.%Y"),
+            "Imsak": "05:00",
+            "Gunes": "07:00",
+            "Ogle": "12:00",
+            "Ikindi": "15:00",
+            "Aksam": "18:00",
+            "Yatsi": "19:30",
+        }
+        for day in range(31)
+    ]
+
+
+def serve(delay, status):
+    body = json.dumps(vakitler()).encode("utf-8") if status == 200 else b""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            time.sleep(delay)
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def providers():
+    transport = Transport(timeout=TIMEOUT, retries=0)
+    servers = (serve(TIMEOUT[1] + 1, 200), serve(1.0, 503), serve(0.3, 200))
+    # One class per server, so the orchestrator keeps separate statistics.
+    return [
+        type(name, (Heroku,), {})(transport, url)
+        for name, url in zip(("Hanging", "Failing", "Working"), servers)
+    ]
+
+
+def main():
+    start = date.today()
+    end = start + timedelta(days=30)
+    # A new district per call keeps the response cache out of the way.
+    cities = (SimpleNamespace(direct_city_id=1, id=index) for index in range(100))
+
+    sequential = providers()
+    started = time.monotonic()
+    for provider in sequential:
+        try:
+            provider.get_range(start, end, next(cities))
+            break
+        except ProviderError:
+            pass
+    print(f"sequential fallback: {time.monotonic() - started:.2f} s")
+
+    orchestrator = ProviderOrchestrator(providers(), hedge_delay=0.5)
+    for index in range(ROUNDS):
+        started = time.monotonic()
+        orchestrator.get_range(start, end, next(cities))
+        order = [orchestrator.name(provider) for provider in orchestrator.ranked()]
+        print(f"orchestrated #{index + 1}: {time.monotonic() - started:.2f} s, next order {order}")
+    if hasattr(orchestrator, "shutdown"):
+        orchestrator.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+"""
+Status.get(date=..., time_name=...) calls per second.
+
+The database holds five years of praying statuses, six per day, and the
+lookups cycle through all of them the way the status polling did.
+"""
+import time
+from datetime import date, timedelta
+
+from common import use_tree
+
+use_tree()
+
+from config import PRAYER_TIMES  # noqa: E402
+from models import Status  # noqa: E402
+
+YEARS = 5
+CALLS = 20000
+
+
+def main():
+    start = date(2021, 1, 1)
+    days = [start + timedelta(days=day) for day in range(365 * YEARS)]
+    Status.create_bulk(
+        chunks=[
+            dict(time_name=time_name, date=day, is_prayed=index % 3 == 0)
+            for index, day in enumerate(days)
+            for time_name in PRAYER_TIMES
+        ]
+    )
+
+    started = time.perf_counter()
+    for index in range(CALLS):
+        Status.get(date=days[index % len(days)], time_name=PRAYER_TIMES[index % 6])
+    elapsed = time.perf_counter() - started
+    print(f"Status.get(date, time_name): {CALLS / elapsed:.0f} calls/s")
+
+
+if __name__ == "__main__":
+    main()
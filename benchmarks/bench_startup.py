@@ -0,0 +1,47 @@
+"""
+Schema work done on every launch against a database already current.
+
+Trees with migrations.migrate run it; older trees replay every
+statement of migrations.STATEMENTS with a commit each, ignoring the
+errors for what already exists, as SQLiteStore.__init__ did.
+"""
+import os
+import sqlite3
+
+from common import best_of, use_tree
+
+use_tree()
+
+import migrations  # noqa: E402
+
+LAUNCHES = 50
+
+
+def start(path):
+    conn = sqlite3.connect(path)
+    if hasattr(migrations, "migrate"):
+        migrations.migrate(conn)
+    else:
+        for statement in migrations.STATEMENTS:
+            try:
+                c = conn.cursor()
+                c.execute(statement)
+                conn.commit()
+            except Exception:
+                pass
+    conn.close()
+
+
+def main():
+    path = os.path.join(os.environ["KIVY_HOME"], "startup.sqlite3")
+    start(path)
+
+    def launches():
+        for _ in range(LAUNCHES):
+            start(path)
+
+    print(f"schema check per launch: {best_of(launches) / LAUNCHES * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""
+Shared setup for the benchmarks.
+
+Every script measures the tree given as its first argument, or this
+repository without one. To compare with an older revision, check it out
+next to the repository and run the script against both:
+
+    git worktree add ../before <commit>
+    python benchmarks/bench_queries.py ../before
+    python benchmarks/bench_queries.py
+"""
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def use_tree(argv=None):
+    """Import the app modules from the measured tree with a fresh Kivy home."""
+    argv = sys.argv if argv is None else argv
+    tree = os.path.abspath(argv[1]) if len(argv) > 1 else ROOT
+    os.environ["KIVY_NO_ARGS"] = "1"
+    os.environ["KIVY_NO_CONSOLELOG"] = "1"
+    os.environ["KIVY_HOME"] = tempfile.mkdtemp(prefix="kivypraying-bench-")
+    sys.path.insert(0, tree)
+    return tree
+
+
+def best_of(func, repeat=5):
+    """Shortest of repeat timed calls of func, in seconds."""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
@@ -0,0 +1,176 @@
+import mmap
+import os
+import struct
+import sys
+from bisect import bisect_left, bisect_right
+
+CATALOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets", "catalog.bin")
+MAGIC = b"PCAT"
+VERSION = 1
+# magic, version, country count, city count
+HEADER = struct.Struct("<4sHII")
+# id, then offset and length of name and key in the string table
+COUNTRY = struct.Struct("<iIHIH")
+# country id, id, direct city id (0 when none), then name and key as above
+CITY = struct.Struct("<iiiIHIH")
+
+
+class _Column(object):
+    """Sequence view over one field of fixed size records, for bisect."""
+
+    def __init__(self, catalog, start, stop, field):
+        self.catalog = catalog
+        self.start = start
+        self.stop = stop
+        self.field = field
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, index):
+        return self.catalog.city(self.start + index)[self.field]
+
+
+class Catalog(object):
+    """
+    Read-only country and city catalog memory-mapped from a snapshot.
+
+    Countries are sorted by id, cities by country id and key, so a
+    country's cities are one contiguous slice found by binary search and
+    nothing is decoded before it is asked for.
+    """
+
+    def __init__(self, path=CATALOG_PATH):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.country_count, self.city_count = HEADER.unpack_from(
+            self._map
+        )
+        if magic != MAGIC or version != VERSION:
+            self._map.close()
+            raise ValueError(f"{path}: not a version {VERSION} catalog")
+        self._cities_at = HEADER.size + COUNTRY.size * self.country_count
+        self._strings_at = self._cities_at + CITY.size * self.city_count
+
+    def close(self):
+        self._map.close()
+
+    def _string(self, offset, length):
+        start = self._strings_at + offset
+        return self._map[start:start + length].decode("utf-8")
+
+    def country(self, index):
+        id_, name, name_len, key, key_len = COUNTRY.unpack_from(
+            self._map, HEADER.size + COUNTRY.size * index
+        )
+        return {
+            "id": id_,
+            "name": self._string(name, name_len),
+            "key": self._string(key, key_len),
+        }
+
+    def city(self, index):
+        country_id, id_, city_id, name, name_len, key, key_len = CITY.unpack_from(
+            self._map, self._cities_at + CITY.size * index
+        )
+        return {
+            "country_id": country_id,
+            "id": id_,
+            "city_id": city_id or None,
+            "name": self._string(name, name_len),
+            "key": self._string(key, key_len),
+        }
+
+    def countries(self):
+        return [self.country(index) for index in range(self.country_count)]
+
+    def _city_slice(self, country_id):
+        column = _Column(self, 0, self.city_count, "country_id")
+        return bisect_left(column, country_id), bisect_right(column, country_id)
+
+    def cities(self, country_id=None):
+        if country_id is None:
+            start, stop = 0, self.city_count
+        else:
+            start, stop = self._city_slice(country_id)
+        return [self.city(index) for index in range(start, stop)]
+
+    def find_city(self, country_id, key):
+        start, stop = self._city_slice(country_id)
+        index = start + bisect_left(_Column(self, start, stop, "key"), key)
+        if index < stop and self.city(index)["key"] == key:
+            return self.city(index)
+        return None
+
+
+def build(path, countries, cities):
+    """Write a snapshot of country and city dicts shaped like Catalog's."""
+    strings = bytearray()
+    offsets = {}
+
+    def string(value):
+        if value not in offsets:
+            data = value.encode("utf-8")
+            offsets[value] = (len(strings), len(data))
+            strings.extend(data)
+        return offsets[value]
+
+    countries = sorted(countries, key=lambda x: x["id"])
+    cities = sorted(cities, key=lambda x: (x["country_id"], x["key"]))
+
+    body = bytearray(HEADER.pack(MAGIC, VERSION, len(countries), len(cities)))
+    for country in countries:
+        body += COUNTRY.pack(
+            country["id"], *string(country["name"]), *string(country["key"])
+        )
+    for city in cities:
+        body += CITY.pack(
+            city["country_id"],
+            city["id"],
+            city.get("city_id") or 0,
+            *string(city["name"]),
+            *string(city["key"]),
+        )
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(body + strings)
+    os.replace(tmp_path, path)
+
+
+def diff(old, new):
+    """
+    Compare two lists of catalog dicts by id.
+
+    Returns (added, changed, removed): records only in new, records of
+    new whose fields differ from old, and ids only in old.
+    """
+    old = {rec["id"]: rec for rec in old}
+    new = {rec["id"]: rec for rec in new}
+    added = [rec for id_, rec in new.items() if id_ not in old]
+    changed = [
+        rec
+        for id_, rec in new.items()
+        if id_ in old and any(old[id_].get(k) != v for k, v in rec.items())
+    ]
+    removed = [id_ for id_ in old if id_ not in new]
+    return added, changed, removed
+
+
+def fetch_remote():
+    """Download the whole catalog, one cities request per country."""
+    from models import Country
+    from providers import Heroku
+
+    heroku = Heroku()
+    countries = heroku.fetch_countries()
+    cities = []
+    for country in countries:
+        for city in heroku.fetch_cities(Country(id=country["id"])):
+            city["country_id"] = country["id"]
+            cities.append(city)
+    return countries, cities
+
+
+if __name__ == "__main__":
+    build(sys.argv[1] if len(sys.argv) > 1 else CATALOG_PATH, *fetch_remote())
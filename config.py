@@ -1,58 +1,82 @@
+import colorsys
+import os
+import weakref
 from datetime import datetime
-from urllib.error import HTTPError
+from functools import lru_cache
 
+from kivy import kivy_home_dir
+from kivy.graphics import Color
+from kivy.utils import get_color_from_hex
+
+from catalog import CATALOG_PATH, Catalog, diff
 from models import City, Country
+from storage import SQLiteDB, SQLiteDBAsync
 
 
 PRAYER_TIMES = ["sabah", "ogle", "ikindi", "aksam", "yatsi", "vitr"]
+# Days of timetable fetched and stored ahead in one provider request.
+PREFETCH_DAYS = 30
+# Seconds between comparisons of a snapshot catalog with the remote one;
+# CATALOG_STAMP's mtime records the last one.
+CATALOG_REFRESH = 30 * 24 * 3600
+CATALOG_STAMP = os.path.join(kivy_home_dir, "catalog_refreshed")
+
+# Per widget, the Color instructions of its canvas, so they are not
+# searched again.
+_colors = weakref.WeakKeyDictionary()
 
 
 def find_parent(cur_class, target_class):
     """find wanted widget from selected or current one"""
+    name = target_class.__name__
     req_class = cur_class
-    while True:
-        cls = str(req_class.__class__).split(".")[1].replace("'>", "")
-        if cls == target_class.__name__:
-            break
-        elif cls == "core":
-            req_class = None
-            break
-
-        req_class = req_class.parent
+    while req_class is not None and req_class.__class__.__name__ != name:
+        req_class = getattr(req_class, "parent", None)
     return req_class
 
 
 def get_colors(obj):
     u"""Color of widget returns."""
-    obj_colors = []
-    try:
-        obj_colors.append(
-            list(
-                filter(lambda x: str(x).find("Color") != -1, obj.canvas.before.children)
-            )[0]
-        )
-    except IndexError:
-        pass
-
-    try:
-        obj_colors.append(
-            list(
-                filter(lambda x: str(x).find("Color") != -1, obj.canvas.after.children)
-            )[0]
-        )
-    except IndexError:
-        pass
-
+    obj_colors = _colors.get(obj)
+    if obj_colors is None:
+        obj_colors = []
+        for canvas in (obj.canvas.before, obj.canvas.after):
+            for instruction in canvas.children:
+                if isinstance(instruction, Color):
+                    obj_colors.append(instruction)
+                    break
+        # A canvas without Color yet may get one later; look again then.
+        if obj_colors:
+            _colors[obj] = obj_colors
     return obj_colors
 
 
 def set_color(obj, color):
-    obj_colors = get_colors(obj)
-    for obj_color in obj_colors:
-        try:
-            obj_color.rgba = color
-        except AttributeError:
-            pass
+    for obj_color in get_colors(obj):
+        current = obj_color.rgba
+        if len(current) == len(color) and all(
+            abs(a - b) < 1e-6 for a, b in zip(current, color)
+        ):
+            continue
+        obj_color.rgba = color
+
+
+@lru_cache(maxsize=32)
+def _hls(hex_color):
+    return colorsys.rgb_to_hls(*get_color_from_hex(hex_color)[:3])
+
+
+def gradient_color(from_hex, to_hex, frame, index):
+    """
+    RGBA of step index in a frame-step gradient between two hex colors.
+
+    Hue, lightness and saturation are interpolated linearly, as colour's
+    Color.range_to does, without building the intermediate colors.
+    """
+    start, end = _hls(from_hex), _hls(to_hex)
+    ratio = min(max(index, 0), frame - 1) / (frame - 1) if frame > 1 else 0
+    hue, lightness, saturation = (a + (b - a) * ratio for a, b in zip(start, end))
+    return [*colorsys.hls_to_rgb(hue, lightness, saturation), 1]
 
 
 def set_children_color(obj, color):
@@ -60,35 +84,141 @@ def set_children_color(obj, color):
         set_color(child, color)
 
 
-def seconds_converter(scnds):
-    seconds = scnds % 60
-    mnts = (scnds - seconds) / 60
-    minutes = mnts % 60
-    hours = (mnts - minutes) / 60
+def _country_row(rec):
+    return dict(name=rec["name"], country_key=rec["key"], id=rec["id"])
 
-    return list(map(lambda x: str(x).zfill(2), map(int, [hours, minutes, seconds])))
+
+def _city_row(rec, country_id):
+    return dict(
+        direct_city_id=rec.get("city_id"),
+        name=rec["name"],
+        city_key=rec["key"],
+        id=rec["id"],
+        country_id=country_id,
+    )
+
+
+def import_catalog(path=CATALOG_PATH):
+    """Load every country and city of the bundled snapshot in one transaction."""
+    catalog = Catalog(path)
+    try:
+        with SQLiteDB.transaction():
+            Country.create_bulk(
+                chunks=[_country_row(rec) for rec in catalog.countries()]
+            )
+            City.create_bulk(
+                chunks=[_city_row(rec, rec["country_id"]) for rec in catalog.cities()]
+            )
+    finally:
+        catalog.close()
+
+
+def catalog_refresh_due():
+    """
+    True when the stored catalog came from the bundled snapshot and was
+    not compared with the remote one for CATALOG_REFRESH seconds.
+    Downloaded catalogs are current already and are not refreshed.
+    """
+    if not os.path.exists(CATALOG_PATH):
+        return False
+    try:
+        refreshed = os.path.getmtime(CATALOG_STAMP)
+    except OSError:
+        return True
+    return datetime.now().timestamp() - refreshed > CATALOG_REFRESH
+
+
+def refresh_catalog():
+    """
+    Download the country catalog and the selected country's cities, then
+    queue the differences with what is stored on the writer thread.
+    """
+    from providers import Heroku, ProviderError
+
+    heroku = Heroku()
+    country = Country.get(selected=True)
+    try:
+        remote_countries = heroku.fetch_countries()
+        remote_cities = heroku.fetch_cities(country) if country else []
+    except ProviderError:
+        return
+    SQLiteDBAsync.write(apply_catalog, country, remote_countries, remote_cities)
+
+
+def apply_catalog(country, remote_countries, remote_cities):
+    """Insert, update and delete only the rows that differ from the remote."""
+    stored = {rec.id: rec for rec in Country.list()}
+    added, changed, removed = diff(
+        [dict(id=rec.id, name=rec.name, key=rec.country_key) for rec in stored.values()],
+        remote_countries,
+    )
+    with SQLiteDB.transaction():
+        if added:
+            Country.create_bulk(chunks=[_country_row(rec) for rec in added])
+        if changed:
+            Country.update_bulk(
+                [
+                    dict(pk=stored[rec["id"]].pk, name=rec["name"], country_key=rec["key"])
+                    for rec in changed
+                ]
+            )
+        if removed:
+            Country.delete(id__in=removed, selected=False)
+            City.delete(country_id__in=removed, selected=False)
+
+        if remote_cities:
+            stored = {rec.id: rec for rec in City.list(country_id=country.id)}
+            added, changed, removed = diff(
+                [
+                    dict(id=rec.id, name=rec.name, key=rec.city_key, city_id=rec.direct_city_id)
+                    for rec in stored.values()
+                ],
+                [dict(rec, city_id=rec.get("city_id")) for rec in remote_cities],
+            )
+            if added:
+                City.create_bulk(chunks=[_city_row(rec, country.id) for rec in added])
+            if changed:
+                City.update_bulk(
+                    [
+                        dict(
+                            pk=stored[rec["id"]].pk,
+                            name=rec["name"],
+                            city_key=rec["key"],
+                            direct_city_id=rec["city_id"],
+                        )
+                        for rec in changed
+                    ]
+                )
+            if removed:
+                City.delete(country_id=country.id, id__in=removed, selected=False)
+
+    with open(CATALOG_STAMP, "a"):
+        pass
+    os.utime(CATALOG_STAMP)
 
 
 def fetch_countries():
-    from providers import Heroku
+    from providers import Heroku, ProviderError
 
     counties = Country.list()
+    if not counties and os.path.exists(CATALOG_PATH):
+        import_catalog()
+        counties = Country.list()
     if not counties:
         try:
             countries = Heroku().fetch_countries()
-        except HTTPError:
+        except ProviderError:
             countries = []
 
-        for country in countries:
-            Country.create(
-                name=country["name"], country_key=country["key"], id=country["id"]
-            )
+        if countries:
+            with SQLiteDB.transaction():
+                Country.create_bulk(chunks=[_country_row(rec) for rec in countries])
     counties = Country.list()
     return counties
 
 
 def fetch_cities():
-    from providers import Heroku
+    from providers import Heroku, ProviderError
 
     country = Country.get(selected=True)
     cities = City.list(country_id=country.id)
@@ -96,20 +226,14 @@ def fetch_cities():
     if not cities:
         try:
             cities = Heroku().fetch_cities(country)
-        except HTTPError:
+        except ProviderError:
             cities = []
 
-        for city in cities:
-            City.create(
-                direct_city_id=city.get('city_id'),
-                name=city["name"],
-                city_key=city["key"],
-                id=city["id"],
-                country_id=country.id,
-            )
+        if cities:
+            with SQLiteDB.transaction():
+                City.create_bulk(chunks=[_city_row(rec, country.id) for rec in cities])
 
-    for city in City.list(country_id=None):
-        City.update(city, country_id=country.pk)
+    City.update_where({"country_id": None}, country_id=country.pk)
 
     cities = City.list(country_id=country.id)
     return cities
@@ -119,9 +243,7 @@ def fetch_selected_country():
     country = Country.get(selected=True)
     if not country:
         country = Country.get(country_key="turkey")
-        for db_country in Country.list():
-            selected = db_country.pk == country.pk
-            Country.update(db_country, selected=selected)
+        Country.select_only(pk=country.pk)
 
     return country
 
@@ -131,9 +253,7 @@ def fetch_selected_city():
     if not city:
         country = Country.get(selected=True)
         city = City.list(country_id=country.id)[0]
-        for db_city in City.list():
-            selected = db_city.pk == city.pk
-            City.update(db_city, selected=selected)
+        City.select_only(pk=city.pk)
 
     return city
 
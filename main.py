@@ -1,8 +1,5 @@
 from datetime import datetime, timedelta
-from urllib.error import HTTPError
 
-from colour import Color
-from dateutil.relativedelta import relativedelta
 from kivy.animation import Animation
 from kivy.app import App
 from kivy.clock import Clock
@@ -24,21 +21,35 @@ from kivy.utils import get_color_from_hex
 from config import (
     find_parent,
     set_children_color,
-    seconds_converter,
     set_color,
     fetch_selected_city,
     fetch_cities,
     fetch_countries,
     COLOR_CODES,
-    fetch_selected_country, PRAYER_TIMES,
+    gradient_color,
+    fetch_selected_country, PRAYER_TIMES, PREFETCH_DAYS,
+    catalog_refresh_due,
+    refresh_catalog,
 )
 from language import Lang
-from models import City, Time, Status, Language, Reward
-from providers import Heroku, CollectApi, Aladhan
-from raw_sql import full_prayed_dates, check_none, fetch_missing_prays
-from storage import SQLiteDB
+from models import City, Time, Status, Language, Reward, DailySummary
+from providers import (
+    Heroku,
+    CollectApi,
+    Aladhan,
+    Astronomical,
+    ProviderOrchestrator,
+)
+from raw_sql import check_none
+from rewards import RewardEngine
+from scheduler import Countdown, DayScheduler
+from state import DayState, MISSED, OPEN, PRAYED, UPCOMING
+from storage import SQLiteDB, SQLiteDBAsync
 
 trans = Lang("en")
+timetables = ProviderOrchestrator(
+    [Aladhan(), Heroku(), CollectApi()], fallback=Astronomical()
+)
 
 
 class RoundedLabel(Label):
@@ -162,8 +173,14 @@ class RecordButton(ButtonBehavior, RoundedLabel):
         root.data.missing_record.clear_widgets()
         root.data.stars.clear_widgets()
 
-        statuses = sorted(Status.list(), key=lambda x: x.date)
-        root.data.info_button.info_text = str(statuses[0].date)
+        SQLiteDBAsync.read(
+            lambda: (Status.min("date"), Status.list()), callback=self._load_records
+        )
+
+    def _load_records(self, result):
+        root = find_parent(self, Praying)
+        first_date, statuses = result
+        root.data.info_button.info_text = str(first_date)
 
         for status in statuses:
             root.records.setdefault(status.date, {}).update(
@@ -200,10 +217,11 @@ class BackButton(ButtonBehavior, RoundedLabel):
 class AddOneDateButton(ButtonBehavior, Label):
     def on_press(self):
         root = find_parent(self, Praying)
-        statuses = sorted(Status.list(), key=lambda x: x.date)
-        day = statuses[0].date - timedelta(days=1)
+        day = Status.min("date") - timedelta(days=1)
+        with SQLiteDB.transaction():
+            for time_name in PRAYER_TIMES:
+                Status.create(time_name=time_name, date=day)
         for time_name in PRAYER_TIMES:
-            Status.create(time_name=time_name, date=day)
             root.records.setdefault(day, {}).update(
                 {time_name: False, "pray_time": str(day)}
             )
@@ -219,6 +237,7 @@ class AddOneDateButton(ButtonBehavior, Label):
         root.data.info_button.info_text = str(day)
 
         root.reset_missed_prays()
+        root.check_praying_status()
         root.check_missed_prays()()
 
 
@@ -230,8 +249,11 @@ class PrayedCheckBox(CheckBox):
 
         self.disabled = True
         root = find_parent(self, Praying)
-        status = Status.get(date=root.today, time_name=self.name)
-        Status.update(status, is_prayed=True)
+        if root.day_state is None:
+            # Today's statuses are loaded on the first status check.
+            root.check_praying_status()
+        root.day_state.mark_prayed(self.name)
+        root.check_praying_status()
 
 
 class MissedCheckBox(CheckBox):
@@ -246,24 +268,31 @@ class MissedCheckBox(CheckBox):
     def on_press(self):
         root = find_parent(self, Praying)
         time = self.name
-        status = None
-
-        for status in sorted(
-                Status.list(time_name=time, is_prayed=False),
-                key=lambda x: x.date,
-                reverse=True,
-        ):
-            try:
-                index = self.db_keys.index(status.pk)
-                self.db_keys.pop(index)
-                break
-            except ValueError:
-                pass
 
+        # One fixed-shape query per step: the latest unprayed day not after
+        # today, paging back only past rows this button does not hold.
+        keys = set(self.db_keys)
+        offset = 0
+        while True:
+            status = Status.get(
+                time_name=time,
+                is_prayed=False,
+                date__lte=root.today,
+                order_by="-date",
+                limit=1,
+                offset=offset,
+            )
+            if status is None or status.pk in keys:
+                break
+            offset += 1
         if not status:
             return
+        self.db_keys.remove(status.pk)
 
         Status.update(status, is_prayed=True)
+        if status.date == root.today and root.day_state:
+            root.day_state.status_prayed(status)
+            root.check_praying_status()
 
         layout = getattr(root.entrance.missed, "missed_{}".format(time))
         label = getattr(layout, "{}_count".format(time))
@@ -329,10 +358,15 @@ class NewDateButton(ButtonBehavior, RoundedLabel):
             set_color(self.day, get_color_from_hex("FF6666"))
             return
 
-        for time in PRAYER_TIMES:
-            Status.create(date=date, time_name=time, is_prayed=self.prayed.active)
+        is_prayed = self.prayed.active
+        Status.create_bulk(
+            chunks=[
+                dict(date=date, time_name=time, is_prayed=is_prayed)
+                for time in PRAYER_TIMES
+            ]
+        )
 
-        self._refresh(is_prayed=self.prayed.active)
+        self._refresh(is_prayed=is_prayed)
 
     def on_press(self):
         if self.name == "new_record":
@@ -391,9 +425,18 @@ class Praying(ScreenManager):
         self.year = self.today.year
         self.weekday = self.today.weekday()
         self.times = None
+        self._timetable_request = None
         self.country = None
         self.city = None
+        self.day_state = None
+        self.countdown = None
         self.app_size = self.calculate_app_size()
+        self._minute = None
+        self.scheduler = DayScheduler(
+            on_transition=self.check_praying_status,
+            on_day_change=self.new_day,
+            on_tick=self.tick,
+        )
         check_none()
         self.progressbar_path(
             path=list(
@@ -413,7 +456,8 @@ class Praying(ScreenManager):
             per_step=int(1000 / 6),
         )
 
-        self.reward_success()
+        self.rewards = RewardEngine(on_reward=self.reward_success)
+        self.rewards.start()
         # self.call = 0
 
     @staticmethod
@@ -435,46 +479,14 @@ class Praying(ScreenManager):
     def animation_complete(self, animation, widget):
         self.entrance.remove_widget(widget)
 
-    def reward_success(self):
-        daily = Reward.get(name="daily")
-        weekly = Reward.get(name="weekly")
-        monthly = Reward.get(name="monthly")
-        yearly = Reward.get(name="yearly")
-
-        try:
-            start_date = full_prayed_dates(min_date=True)
-            end_date = full_prayed_dates(max_date=True)
-            missing_between = fetch_missing_prays(start_date, end_date)
-            end_date -= timedelta(days=missing_between)
-            time_difference = relativedelta(end_date, start_date)
-            calc_yearly = time_difference.years
-            calc_monthly = time_difference.months
-            calc_weekly = int(time_difference.days / 7)
-            calc_daily = time_difference.days % 7
-        except TypeError:
-            calc_yearly = 0
-            calc_monthly = 0
-            calc_weekly = 0
-            calc_daily = 0
-
-        stars = []
-        if calc_yearly > yearly.count:
-            stars.append(Star(color=COLOR_CODES.get("purple")))
-        if calc_monthly > monthly.count:
-            stars.append(Star(color=COLOR_CODES.get("red")))
-        if calc_weekly > weekly.count:
-            stars.append(Star(color=COLOR_CODES.get("orange")))
-        if calc_daily > daily.count:
-            stars.append(Star(color=COLOR_CODES.get("yellow")))
-
-        self.run_stars(stars)
-
-        Reward.update(daily, count=calc_daily)
-        Reward.update(weekly, count=calc_weekly)
-        Reward.update(monthly, count=calc_monthly)
-        Reward.update(yearly, count=calc_yearly)
-
-        Clock.schedule_once(lambda dt: self.reward_success(), 0.5)
+    def reward_success(self, gained):
+        colors = {
+            "yearly": "purple",
+            "monthly": "red",
+            "weekly": "orange",
+            "daily": "yellow",
+        }
+        self.run_stars([Star(color=COLOR_CODES.get(colors[name])) for name in gained])
 
     def run_stars(self, star_set):
         try:
@@ -518,41 +530,73 @@ class Praying(ScreenManager):
         )
 
     def fetch_today_praying_times(self):
-        record = {}
         city = City.get(selected=True)
         times = Time.list(date=self.today, city_id=city.pk)
+        if times:
+            self.load_praying_times(times)
+            return
 
-        if not times:
-            for provider in (Aladhan(), Heroku(), CollectApi(),):
-                try:
-                    record = provider(self.today, self.city)
-                    break
-                except (HTTPError, IndexError) as e:
-                    pass
+        # Nothing to show until the providers answer; they run off the
+        # main thread and load_praying_times runs again once stored.
+        self.load_praying_times([])
+        start, end = self.today, self.today + timedelta(days=PREFETCH_DAYS)
+        request = self._timetable_request = (city.pk, start)
 
-            for time in record.items():
-                Time.create(
+        def store(records):
+            SQLiteDBAsync.write(
+                self.store_praying_times, city, start, end, records, callback=loaded
+            )
+
+        def loaded(times):
+            if self._timetable_request == request:
+                self.load_praying_times(times)
+                self.check_praying_status()
+
+        timetables.submit("get_range", start, end, city, callback=store)
+
+    @staticmethod
+    def store_praying_times(city, start, end, records):
+        stored = set(
+            map(
+                lambda x: x.date,
+                Time.list(city_id=city.pk, date__between=(start, end)),
+            )
+        )
+        Time.create_bulk(
+            chunks=[
+                dict(
                     city_id=city.pk,
-                    time_name=time[0],
-                    from_time=time[1][0],
-                    to_time=time[1][1],
-                    date=self.today,
+                    time_name=time_name,
+                    from_time=from_time,
+                    to_time=to_time,
+                    date=day,
                 )
-        self.times = Time.list(date=self.today, city_id=city.pk)
+                for day, record in records.items()
+                if day not in stored
+                for time_name, (from_time, to_time) in record.items()
+            ]
+        )
+        return Time.list(date=start, city_id=city.pk)
+
+    def load_praying_times(self, times):
+        self._timetable_request = None
+        self.times = times
+        # Every reload path passes here; statuses are read again on the
+        # next check_praying_status and all widgets redrawn once.
+        self.day_state = None
+        self.countdown = Countdown(self.times)
+        self.scheduler.load(self.times)
 
         self.check_praying_time_left()
 
     def check_praying_time_left(self):
         now = datetime.now()
         # now = datetime(2021, 3, 24, 14) + timedelta(seconds=self.call * 60)
-        from_color = Color("#B8D5CD")
-        to_color = Color("#FF6666")
-        for praying_time_name in PRAYER_TIMES:
-            praying_time_obj = list(
-                filter(lambda x: x.time_name == praying_time_name, self.times)
-            )[0]
+        for praying_time_obj in self.times:
             praying_time = praying_time_obj.from_time
-            label = getattr(self.praying_times, "{}_time".format(praying_time_name))
+            label = getattr(
+                self.praying_times, "{}_time".format(praying_time_obj.time_name)
+            )
             label.text = praying_time.strftime("%H:%M")
 
             if praying_time_obj.from_time <= now <= praying_time_obj.to_time:
@@ -563,25 +607,23 @@ class Praying(ScreenManager):
                     / 60
                 )
                 index = int((now - praying_time_obj.from_time).total_seconds() / 60) - 1
-                color_set = list(from_color.range_to(to_color, frame))
-                current_hex = color_set[index].get_hex().strip("#")
-                set_color(label, get_color_from_hex(current_hex))
+                set_color(label, gradient_color("B8D5CD", "FF6666", frame, index))
         # self.call += 1
-        Clock.schedule_once(lambda dt: self.check_praying_time_left(), 10)
 
     def check_praying_status(self):
-        if not Status.get(date=self.today):
-            for time_name in PRAYER_TIMES:
-                Status.create(time_name=time_name, date=self.today)
-
-        for pray_time in self.times:
-            time_name = pray_time.time_name
-            if Status.get(date=self.today, time_name=time_name).is_prayed:  # Prayed
-                button = getattr(self.entrance, time_name)
+        if self.day_state is None:
+            if not Status.exists(date=self.today):
+                with SQLiteDB.transaction():
+                    for time_name in PRAYER_TIMES:
+                        Status.create(time_name=time_name, date=self.today)
+            self.day_state = DayState(self.today, self.times)
+
+        for time_name, state in self.day_state.diff(datetime.now()).items():
+            button = getattr(self.entrance, time_name)
+            if state == PRAYED:
                 button.active = button.disabled = True
                 set_children_color(button.parent, get_color_from_hex("B8D5CD"))
-            elif datetime.now() > pray_time.to_time:  # Missed
-                button = getattr(self.entrance, time_name)
+            elif state == MISSED:
                 button.disabled = True
                 set_children_color(button.parent, get_color_from_hex("FF6666"))
 
@@ -589,7 +631,7 @@ class Praying(ScreenManager):
                 button = getattr(layout, "{}_button".format(time_name))
                 label = getattr(layout, "{}_count".format(time_name))
 
-                status = Status.get(time_name=time_name, date=self.today)
+                status = self.day_state.statuses[time_name]
                 if status.pk not in button.db_keys:
                     button.db_keys.append(status.pk)
 
@@ -597,17 +639,13 @@ class Praying(ScreenManager):
                     label.text = str((label.text and int(label.text) or 0) + 1)
                     set_children_color(layout, get_color_from_hex("FF6666"))
 
-            elif datetime.now() < pray_time.from_time:  # on time
-                button = getattr(self.entrance, time_name)
+            elif state == UPCOMING:
                 button.disabled = True
                 set_children_color(button.parent, get_color_from_hex("D2D1BE"))
-            else:  # wait for time
-                button = getattr(self.entrance, time_name)
+            elif state == OPEN:
                 button.disabled = button.active = False
                 set_children_color(button.parent, get_color_from_hex("FFFFFF"))
 
-        Clock.schedule_once(lambda dt: self.check_praying_status(), 0.5)
-
     def reset_missed_prays(self):
         times = {
             "sabah": None,
@@ -625,33 +663,35 @@ class Praying(ScreenManager):
             button.db_keys = []
             label.text = ""
             set_children_color(layout, get_color_from_hex("B8D5CD"))
+        if self.day_state is not None:
+            # Today's missed prayers were cleared from the list as well.
+            self.day_state.redraw(MISSED)
 
     def check_missed_prays(self, is_prayed=False):
-        def inner():
-            times = {
-                "sabah": None,
-                "ogle": None,
-                "ikindi": None,
-                "aksam": None,
-                "yatsi": None,
-                "vitr": None,
-            }
-            visits = list(
-                map(lambda x: x.date, set(filter(lambda x: x.date, Status.list())))
-            )
-
-            visits = sorted(visits)
+        def fill_gaps():
+            visits = [summary.date for summary in DailySummary.list(order_by="date")]
             d1 = visits and visits[0] or datetime.now()
             d2 = visits and visits[-1] or datetime.now()
             days = set([d1 + timedelta(n) for n in range(1, int((d2 - d1).days))])
             chunks = []
             for day in days.difference(set(visits)):
-                for time in times:
+                for time in PRAYER_TIMES:
                     chunks.append(dict(time_name=time, date=day, is_prayed=is_prayed))
             if chunks:
                 Status.create_bulk(chunks=chunks)
 
-            for status in Status.list(is_prayed=False):
+            return Status.list(is_prayed=False)
+
+        def show_missed(statuses):
+            times = {
+                "sabah": None,
+                "ogle": None,
+                "ikindi": None,
+                "aksam": None,
+                "yatsi": None,
+                "vitr": None,
+            }
+            for status in statuses:
                 if status.date == self.today:
                     continue
 
@@ -674,37 +714,39 @@ class Praying(ScreenManager):
                     continue
                 set_children_color(layout, get_color_from_hex("B8D5CD"))
 
+        def inner():
+            SQLiteDBAsync.write(fill_gaps, callback=show_missed)
+
         return inner
 
-    def check_counter(self, **kwargs):
-        now = datetime.now()
-        records = Time.list(date=self.today)
-        if not records:
-            Clock.schedule_once(lambda dt: self.check_counter(), 0.5)
+    def check_counter(self, now=None, **kwargs):
+        if self.countdown is None:
             return
-        upcoming = None
-        current = None
-        total_second = 0
-        for key in PRAYER_TIMES:
-            record = list(filter(lambda x: x.time_name == key, records))[0]
-            if record.from_time < now < record.to_time:
-                current = record.to_time
-                break
-            if record.from_time > now:
-                upcoming = record.from_time
-                break
-
-        if current is not None:
-            total_second = int((current - now).total_seconds())
-        if upcoming is not None:
-            total_second = int((upcoming - now).total_seconds())
-
-        hours, minutes, seconds = seconds_converter(total_second)
-        self.entrance.info.hours.text = hours
-        self.entrance.info.minutes.text = minutes
-        self.entrance.info.seconds.text = seconds
-
-        Clock.schedule_once(lambda dt: self.check_counter(), 0.5)
+        now = now or datetime.now()
+        hours, minutes, seconds = self.countdown.update(now.timestamp())
+        if hours is not None:
+            self.entrance.info.hours.text = hours
+        if minutes is not None:
+            self.entrance.info.minutes.text = minutes
+        if seconds is not None:
+            self.entrance.info.seconds.text = seconds
+
+    def tick(self, now):
+        self.check_counter(now)
+        if now.minute != self._minute:
+            self._minute = now.minute
+            self.check_praying_time_left()
+
+    def new_day(self):
+        self.today = datetime.now().date()
+        self.day = self.today.day
+        self.month = self.today.month
+        self.year = self.today.year
+        self.weekday = self.today.weekday()
+        self.fetch_today_praying_times()
+        self.reset_missed_prays()
+        self.check_praying_status()
+        self.check_missed_prays()()
 
     def load_stars(self):
         daily = Reward.get(name="daily").count
@@ -766,9 +808,7 @@ class Praying(ScreenManager):
     def switch_lang(self, lang=None):
         lang = lang or trans.lang
         trans.switch_lang(lang)
-        for language in Language.list():
-            selected = language.lang == lang
-            Language.update(language, selected=selected)
+        Language.select_only(lang=lang)
         self.settings.lang_selection.set_text()
 
 
@@ -790,6 +830,15 @@ class PrayingApp(App):
         fetch_selected_city()
         return Praying()
 
+    def on_start(self):
+        if catalog_refresh_due():
+            SQLiteDBAsync.read(refresh_catalog)
+
+    def on_stop(self):
+        timetables.shutdown()
+        SQLiteDBAsync.shutdown()
+        SQLiteDB.close()
+
 
 if __name__ == "__main__":
     Window.clearcolor = get_color_from_hex("E2DDD5")
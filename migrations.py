@@ -1,6 +1,168 @@
-STATEMENTS = (
+def add_column(table, column, column_type):
+    """Data-aware step adding a column unless an older build already did."""
+
+    def step(conn):
+        columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+        if column not in columns:
+            conn.execute(f"alter table {table} add column {column} {column_type}")
+
+    return step
+
+
+def compact_praying_status(conn):
     """
-    create table countries (
+    Move praying_status to one row per day with bit masks.
+
+    praying_days keeps, per day number (days since 1970-01-01), a mask of
+    the prayer slots recorded and a mask of those prayed, bits following
+    config.PRAYER_TIMES. praying_status becomes a view over it with
+    INSTEAD OF triggers, so the Status model keeps its columns and pks
+    are day * 8 + bit.
+    """
+    for statement in (
+        """
+        create table praying_days (
+            day integer not null primary key,
+            slots integer not null default 0,
+            prayed integer not null default 0
+        )
+        """,
+        """
+        create table prayer_slots (
+            bit integer not null primary key,
+            time_name text not null unique
+        )
+        """,
+        """
+        insert into prayer_slots (bit, time_name) values
+            (0, 'sabah'), (1, 'ogle'), (2, 'ikindi'),
+            (3, 'aksam'), (4, 'yatsi'), (5, 'vitr')
+        """,
+        """
+        insert into praying_days (day, slots, prayed)
+        select cast(julianday(date) - 2440587.5 as integer),
+               sum(1 << bit),
+               sum(prayed << bit)
+        from (
+            select p.date, s.bit, max(coalesce(p.is_prayed, 0) != 0) as prayed
+            from praying_status p
+            join prayer_slots s on s.time_name = p.time_name
+            where julianday(p.date) is not null
+            group by p.date, s.bit
+        )
+        group by date
+        """,
+        "drop table praying_status",
+        "CREATE INDEX idx_praying_days_date ON praying_days (date(day + 2440587.5))",
+        "CREATE INDEX idx_praying_days_prayed ON praying_days (prayed)",
+        """
+        create view praying_status as
+        select d.day * 8 + s.bit as pk,
+               s.time_name as time_name,
+               (d.prayed >> s.bit) & 1 as is_prayed,
+               date(d.day + 2440587.5) as date
+        from praying_days d
+        join prayer_slots s on d.slots & (1 << s.bit)
+        """,
+        """
+        create trigger praying_status_insert instead of insert on praying_status
+        when new.time_name in (select time_name from prayer_slots)
+        begin
+            insert or ignore into praying_days (day)
+            values (cast(julianday(new.date) - 2440587.5 as integer));
+            update praying_days
+            set slots = slots | (1 << (select bit from prayer_slots where time_name = new.time_name)),
+                prayed = (prayed & ~(1 << (select bit from prayer_slots where time_name = new.time_name)))
+                         | ((coalesce(new.is_prayed, 0) != 0)
+                            << (select bit from prayer_slots where time_name = new.time_name))
+            where day = cast(julianday(new.date) - 2440587.5 as integer);
+        end
+        """,
+        """
+        create trigger praying_status_update instead of update of is_prayed on praying_status
+        begin
+            update praying_days
+            set prayed = (prayed & ~(1 << (old.pk % 8)))
+                         | ((coalesce(new.is_prayed, 0) != 0) << (old.pk % 8))
+            where day = old.pk / 8;
+        end
+        """,
+        """
+        create trigger praying_status_delete instead of delete on praying_status
+        begin
+            update praying_days
+            set slots = slots & ~(1 << (old.pk % 8)),
+                prayed = prayed & ~(1 << (old.pk % 8))
+            where day = old.pk / 8;
+            delete from praying_days where day = old.pk / 8 and slots = 0;
+        end
+        """,
+    ):
+        conn.execute(statement)
+
+
+PRAYED_COUNT = "+".join(f"((%(mask)s >> {bit}) & 1)" for bit in range(6))
+
+
+def daily_summary(conn):
+    """
+    Add daily_summary, one row per day with its prayed count and whether
+    it is complete, kept current by triggers on praying_days (the table
+    behind the praying_status view). pk is the praying_days day number.
+    """
+    for statement in (
+        """
+        create table daily_summary (
+            pk integer not null primary key,
+            date text not null,
+            prayed_count integer not null default 0,
+            is_complete boolean not null default false
+        )
+        """,
+        "CREATE UNIQUE INDEX idx_daily_summary_date ON daily_summary (date)",
+        "CREATE INDEX idx_daily_summary_complete ON daily_summary (is_complete, date)",
+        f"""
+        insert into daily_summary (pk, date, prayed_count, is_complete)
+        select day, date(day + 2440587.5), {PRAYED_COUNT % {"mask": "prayed"}}, prayed = 63
+        from praying_days
+        """,
+        f"""
+        create trigger praying_days_insert after insert on praying_days
+        begin
+            insert into daily_summary (pk, date, prayed_count, is_complete)
+            values (
+                new.day,
+                date(new.day + 2440587.5),
+                {PRAYED_COUNT % {"mask": "new.prayed"}},
+                new.prayed = 63
+            );
+        end
+        """,
+        f"""
+        create trigger praying_days_update after update of prayed on praying_days
+        begin
+            update daily_summary
+            set prayed_count = {PRAYED_COUNT % {"mask": "new.prayed"}},
+                is_complete = new.prayed = 63
+            where pk = new.day;
+        end
+        """,
+        """
+        create trigger praying_days_delete after delete on praying_days
+        begin
+            delete from daily_summary where pk = old.day;
+        end
+        """,
+    ):
+        conn.execute(statement)
+
+
+# Every entry is one schema version, applied in order. Entries are SQL
+# statements or callables taking the connection, for data migrations.
+# Append new steps at the end; never edit or reorder released ones.
+MIGRATIONS = (
+    """
+    create table if not exists countries (
         pk integer not null primary key autoincrement,
         name text,
         country_key text,
@@ -9,7 +171,7 @@ STATEMENTS = (
     )
     """,
     """
-    create table cities (
+    create table if not exists cities (
         pk integer not null primary key autoincrement,
         name text,
         city_key text,
@@ -18,7 +180,7 @@ STATEMENTS = (
     )
     """,
     """
-    create table times (
+    create table if not exists times (
         pk integer not null primary key autoincrement,
         time_name text,
         from_time text,
@@ -29,7 +191,7 @@ STATEMENTS = (
     )
     """,
     """
-    create table praying_status (
+    create table if not exists praying_status (
         pk integer not null primary key autoincrement,
         time_name text,
         is_prayed boolean default false,
@@ -37,7 +199,7 @@ STATEMENTS = (
     )
     """,
     """
-    create table languages (
+    create table if not exists languages (
         pk integer not null primary key autoincrement,
         lang text,
         lang_text text,
@@ -45,24 +207,56 @@ STATEMENTS = (
     )
     """,
     """
-    create table rewards (
+    create table if not exists rewards (
         pk integer not null primary key autoincrement,
         name text,
         count integer
     )
     """,
-    "CREATE UNIQUE INDEX idx_rewards_name ON rewards (name)",
-    "CREATE UNIQUE INDEX idx_languages_lang ON languages (lang)",
+    "CREATE UNIQUE INDEX if not exists idx_rewards_name ON rewards (name)",
+    "CREATE UNIQUE INDEX if not exists idx_languages_lang ON languages (lang)",
     "insert into rewards (name, count) select 'daily', 0 where not exists(select 1 from rewards where name='daily')",
     "insert into rewards (name, count) select 'weekly', 0 where not exists(select 1 from rewards where name='weekly')",
     "insert into rewards (name, count) select 'monthly', 0 where not exists(select 1 from rewards where name='monthly')",
     "insert into rewards (name, count) select 'yearly', 0 where not exists(select 1 from rewards where name='yearly')",
     "insert into languages (lang, lang_text) select 'tr', 'Türkçe' where not exists(select 1 from languages where lang='tr')",
     "insert into languages (lang, lang_text) select 'en', 'English' where not exists(select 1 from languages where lang='en')",
-    "CREATE INDEX idx_praying_status_date_prayed ON praying_status (is_prayed, date)",
-    "CREATE INDEX idx_praying_status_isprayed ON praying_status (is_prayed)",
-    "CREATE INDEX idx_praying_status_date ON praying_status (date)",
-    "CREATE INDEX idx_times_date ON times (date)",
-    "alter table cities add column country_id int",
-    "alter table cities add column direct_city_id int",
+    "CREATE INDEX if not exists idx_praying_status_date_prayed ON praying_status (is_prayed, date)",
+    "CREATE INDEX if not exists idx_praying_status_isprayed ON praying_status (is_prayed)",
+    "CREATE INDEX if not exists idx_praying_status_date ON praying_status (date)",
+    "CREATE INDEX if not exists idx_times_date ON times (date)",
+    add_column("cities", "country_id", "int"),
+    add_column("cities", "direct_city_id", "int"),
+    compact_praying_status,
+    daily_summary,
+    add_column("cities", "latitude", "real"),
+    add_column("cities", "longitude", "real"),
+    add_column("cities", "timezone", "text"),
+    add_column("cities", "district_id", "int"),
 )
+
+
+def migrate(conn):
+    """
+    Bring the database up to the latest schema version.
+
+    The applied version lives in PRAGMA user_version, so a current schema
+    costs one pragma read. Pending steps run in a single transaction.
+    """
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version >= len(MIGRATIONS):
+        return version
+
+    conn.execute("begin")
+    try:
+        for step in MIGRATIONS[version:]:
+            if callable(step):
+                step(conn)
+            else:
+                conn.execute(step)
+        conn.execute(f"PRAGMA user_version = {len(MIGRATIONS)}")
+    except Exception:
+        conn.rollback()
+        raise
+    conn.commit()
+    return len(MIGRATIONS)
@@ -1,26 +1,88 @@
 from datetime import datetime, date
+from functools import lru_cache
 
 from storage import SQLiteDB
 
 
-class ModelBase:
+@lru_cache(maxsize=8192)
+def _parse_date(value):
+    return value and datetime.strptime(value, "%Y-%m-%d").date()
+
+
+@lru_cache(maxsize=8192)
+def _parse_datetime(value):
+    return datetime.strptime(value, "%d.%m.%Y %H:%M")
+
+
+CONVERTERS = {
+    date: _parse_date,
+    datetime: _parse_datetime,
+    bool: bool,
+    int: int,
+    str: str,
+}
+
+
+class ModelMeta(type):
+    """Give every model __slots__ for its annotated columns."""
+
+    def __new__(mcs, name, bases, namespace):
+        # A column slot would replace the inherited attribute of that name.
+        clashes = [
+            column
+            for column in namespace.get("__annotations__", {})
+            if any(hasattr(base, column) for base in bases)
+        ]
+        if clashes:
+            raise TypeError(f"{name}: columns {clashes} shadow ModelBase attributes")
+        namespace.setdefault("__slots__", tuple(namespace.get("__annotations__", {})))
+        cls = super(ModelMeta, mcs).__new__(mcs, name, bases, namespace)
+        cls._hydrators = {}
+        for table in getattr(namespace.get("Meta"), "depends_on", ()):
+            SQLiteDB.add_dependency(namespace["Meta"].db_name, table)
+        return cls
+
+
+class ModelBase(metaclass=ModelMeta):
     def __init__(self, **kwargs):
         for key, value in kwargs.items():
-            annotation = self.__annotations__.get(key)
-            if value is None:
-                value = None
-            elif annotation == date:
-                value = value and datetime.strptime(value, "%Y-%m-%d").date()
-            elif annotation == datetime:
-                value = datetime.strptime(value, "%d.%m.%Y %H:%M")
-            elif annotation == bool:
-                value = bool(value)
-            elif annotation == int:
-                value = int(value)
-            elif annotation == str:
-                value = str(value)
+            converter = CONVERTERS.get(self.__annotations__.get(key))
+            if value is not None and converter is not None:
+                value = converter(value)
             setattr(self, key, value)
 
+    @classmethod
+    def hydrator(cls, description):
+        """
+        Return a function building an instance from a row in column order.
+
+        The function is generated once per column layout and assigns every
+        annotated column straight to its slot, skipping the kwargs path.
+        """
+        hydrate = cls._hydrators.get(description)
+        if hydrate is not None:
+            return hydrate
+
+        namespace = {"cls": cls, "new": object.__new__}
+        lines = ["def hydrate(row):", "    obj = new(cls)"]
+        for index, column in enumerate(description):
+            if column not in cls.__annotations__:
+                continue
+            converter = CONVERTERS.get(cls.__annotations__[column])
+            if converter is None:
+                lines.append(f"    obj.{column} = row[{index}]")
+                continue
+            namespace[f"convert_{index}"] = converter
+            lines.append(f"    value = row[{index}]")
+            lines.append(
+                f"    obj.{column} = None if value is None else convert_{index}(value)"
+            )
+        lines.append("    return obj")
+        exec("\n".join(lines), namespace)
+
+        hydrate = cls._hydrators[description] = namespace["hydrate"]
+        return hydrate
+
     @classmethod
     def list(cls, **kwargs):
         return SQLiteDB.list(cls, **kwargs)
@@ -29,6 +91,29 @@ class ModelBase:
     def get(cls, **kwargs):
         return SQLiteDB.retrieve(cls, **kwargs)
 
+    @classmethod
+    def count_rows(cls, **kwargs):
+        return SQLiteDB.aggregate(cls, "count", **kwargs)
+
+    @classmethod
+    def min(cls, field, **kwargs):
+        return cls._convert(field, SQLiteDB.aggregate(cls, "min", field, **kwargs))
+
+    @classmethod
+    def max(cls, field, **kwargs):
+        return cls._convert(field, SQLiteDB.aggregate(cls, "max", field, **kwargs))
+
+    @classmethod
+    def exists(cls, **kwargs):
+        return SQLiteDB.exists(cls, **kwargs)
+
+    @classmethod
+    def _convert(cls, field, value):
+        converter = CONVERTERS.get(cls.__annotations__.get(field))
+        if value is None or converter is None:
+            return value
+        return converter(value)
+
     @classmethod
     def create(cls, **kwargs):
         return SQLiteDB.create(cls, **kwargs)
@@ -40,6 +125,18 @@ class ModelBase:
     def update(self, **kwargs):
         return SQLiteDB.update(self, **kwargs)
 
+    @classmethod
+    def update_where(cls, filter=None, **kwargs):
+        return SQLiteDB.update_where(cls, filter, **kwargs)
+
+    @classmethod
+    def update_bulk(cls, rows):
+        return SQLiteDB.update_bulk(cls, rows)
+
+    @classmethod
+    def select_only(cls, **kwargs):
+        return SQLiteDB.select_only(cls, **kwargs)
+
     @classmethod
     def delete(cls, **kwargs):
         return SQLiteDB.delete(cls, **kwargs)
@@ -64,6 +161,10 @@ class City(ModelBase):
     selected: bool
     country_id: int
     direct_city_id: int
+    latitude: float
+    longitude: float
+    timezone: str
+    district_id: int
 
     class Meta:
         db_name = "cities"
@@ -95,6 +196,18 @@ class Status(ModelBase):
         db_name = "praying_status"
 
 
+class DailySummary(ModelBase):
+    pk: int
+    date: date
+    prayed_count: int
+    is_complete: bool
+
+    class Meta:
+        db_name = "daily_summary"
+        # Maintained by triggers on writes to praying_status.
+        depends_on = ("praying_status",)
+
+
 class Language(ModelBase):
     pk: int
     lang: str
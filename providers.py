@@ -1,26 +1,264 @@
-import http.client
+import hashlib
 import json
-import ssl
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import date, datetime, timedelta
+
 import requests
-from datetime import timedelta
+from kivy import kivy_home_dir
+from kivy.clock import Clock
+from kivy.logger import Logger
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from config import _concat_date_time, _date_parser
+from storage import SQLiteDBAsync
+
+# Seconds to connect and to wait for a response.
+TIMEOUT = (5, 15)
+RETRIES = 2
+BACKOFF = 0.5
+# By URL part: seconds a cached response is served without asking the
+# server, and the age up to which it still stands in when the request
+# fails or the transport is offline (None: any age).
+CACHE_TTLS = (
+    ("/ulkeler", 30 * 24 * 3600, None),
+    ("/sehirler/", 30 * 24 * 3600, None),
+    ("/ilceler/", 30 * 24 * 3600, None),
+    ("/vakitler", 24 * 3600, 30 * 24 * 3600),
+    ("/calendarByCity/", 7 * 24 * 3600, None),
+    ("/timingsByCity/", 12 * 3600, None),
+    ("/pray/all", 3600, 24 * 3600),
+)
+# Endpoints answering for "today" without a date in the URL or payload;
+# their cache key carries the local date so no other day is served.
+UNDATED = ("/pray/all",)
+CACHE_MAX_BYTES = 8 * 1024 * 1024
+# Seconds to wait on the running providers before starting the next one.
+HEDGE_DELAY = 1.5
+
+
+class ProviderError(Exception):
+    """A provider request failed or returned an unusable response."""
+
+
+class ResponseCache:
+    """
+    On-disk JSON response cache, one file per URL and parameters.
+
+    Entries keep the payload with its ETag/Last-Modified validators and
+    the time it was stored. Reads bump the file's mtime, and once the
+    directory grows past max_bytes the least recently used files go.
+    """
+
+    def __init__(self, path, max_bytes=CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key):
+        digest = hashlib.sha1(json.dumps(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.path, f"{digest}.json")
+
+    def get(self, key):
+        file_path = self._file(key)
+        try:
+            with open(file_path, encoding="utf-8") as f:
+                entry = json.load(f)
+            os.utime(file_path)
+        except (OSError, ValueError):
+            return None
+        return entry
+
+    def set(self, key, entry):
+        file_path = self._file(key)
+        tmp_path = f"{file_path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, file_path)
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            files = []
+            for name in os.listdir(self.path):
+                if name.endswith(".json"):
+                    stat = os.stat(os.path.join(self.path, name))
+                    files.append((stat.st_mtime, stat.st_size, name))
+            total = sum(size for _, size, _ in files)
+            for _, size, name in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                os.remove(os.path.join(self.path, name))
+                total -= size
+
+
+class Transport:
+    """
+    HTTP layer shared by every provider.
 
-ssl._create_default_https_context = ssl._create_unverified_context
+    One requests.Session keeps connections alive per host; requests get
+    a timeout, retries with exponential backoff on connection errors and
+    5xx, and gzip. Read timeouts are not retried, so a hanging server
+    costs one read timeout. Responses are kept in a ResponseCache: fresh entries
+    (see CACHE_TTLS) skip the network, stale ones are revalidated with
+    ETag and If-Modified-Since and served as they are when the request
+    fails, up to their endpoint's maximum age. With offline set, only
+    the cache is used.
+    """
+
+    def __init__(self, timeout=TIMEOUT, retries=RETRIES, backoff=BACKOFF,
+                 cache=None, offline=False):
+        self.timeout = timeout
+        self.cache = cache
+        self.offline = offline
+        self.session = requests.Session()
+        self.session.headers["Accept-Encoding"] = "gzip, deflate"
+        retry = Retry(
+            total=retries,
+            read=0,
+            backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=("GET",),
+        )
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._validated = {}
+
+    @staticmethod
+    def cache_key(url, params=None):
+        key = [url, sorted((str(k), str(v)) for k, v in (params or {}).items())]
+        if any(pattern in url for pattern in UNDATED):
+            key.append(date.today().isoformat())
+        return key
+
+    @staticmethod
+    def policy(url):
+        """Return (ttl, max_stale) seconds for url, see CACHE_TTLS."""
+        for pattern, ttl, max_stale in CACHE_TTLS:
+            if pattern in url:
+                return ttl, max_stale
+        return 0, None
+
+    def _cached(self, key):
+        if self.cache is not None:
+            return self.cache.get(key)
+        return self._validated.get(json.dumps(key))
+
+    def _store(self, key, entry):
+        if self.cache is not None:
+            self.cache.set(key, entry)
+        else:
+            self._validated[json.dumps(key)] = entry
+
+    def get_json(self, url, params=None, headers=None):
+        key = self.cache_key(url, params)
+        cached = self._cached(key)
+        ttl, max_stale = self.policy(url)
+        age = cached and time.time() - cached["stored_at"]
+        usable = cached and (max_stale is None or age < max_stale)
+        if cached and (age < ttl or self.offline and usable):
+            return cached["payload"]
+        if self.offline:
+            raise ProviderError(f"{url}: not cached and offline")
+
+        headers = dict(headers or {})
+        if cached:
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+
+        try:
+            response = self.session.get(
+                url, params=params, headers=headers, timeout=self.timeout
+            )
+            if response.status_code == 304 and cached:
+                payload = cached["payload"]
+            else:
+                response.raise_for_status()
+                payload = response.json()
+        except (requests.RequestException, ValueError) as e:
+            if usable:
+                return cached["payload"]
+            raise ProviderError(f"{url}: {e}") from e
+
+        self._store(
+            key,
+            {
+                "stored_at": time.time(),
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "payload": payload,
+            },
+        )
+        return payload
+
+
+TRANSPORT = Transport(cache=ResponseCache(os.path.join(kivy_home_dir, "http_cache")))
+
+
+def store_on_city(city, **values):
+    """
+    Set values on the city instance and queue their write.
+
+    Providers run on worker threads, so the row is written by the
+    storage writer thread while callers holding city see the values now.
+    """
+    for key, value in values.items():
+        setattr(city, key, value)
+    SQLiteDBAsync.write(city.update, **values)
 
 
 class BaseProvider(object):
+    """
+    Timetable source. Subclasses implement get, get_range or both.
+
+    get returns one day's record, {time_name: (from_time, to_time)};
+    get_range returns {date: record} for the days between start and end
+    (both included) the source could provide.
+    """
+
+    BASE_URL = None
+
+    def __init__(self, transport=None, base_url=None):
+        self.transport = transport or TRANSPORT
+        self.base_url = base_url or self.BASE_URL
+
+    def fetch(self, path, params=None, headers=None):
+        return self.transport.get_json(f"{self.base_url}{path}", params, headers)
+
     def get(self, today, city):
-        raise NotImplementedError
+        records = self.get_range(today, today, city)
+        if today not in records:
+            raise IndexError(today)
+        return records[today]
+
+    def get_range(self, start, end, city):
+        records = {}
+        day = start
+        while day <= end:
+            records[day] = self.get(day, city)
+            day += timedelta(days=1)
+        return records
 
     def __call__(self, today, city):
         return self.get(today, city)
 
 
 class Heroku(BaseProvider):
-    @staticmethod
-    def fetch_countries():
-        data = requests.get("http://ezanvakti.herokuapp.com/ulkeler").json()
+    BASE_URL = "http://ezanvakti.herokuapp.com"
+
+    def __init__(self, transport=None, base_url=None):
+        super(Heroku, self).__init__(transport, base_url)
+        self._districts = {}
+
+    def fetch_countries(self):
+        data = self.fetch("/ulkeler")
         record = []
         for rec in data:
             record.append(
@@ -32,14 +270,13 @@ class Heroku(BaseProvider):
             )
         return record
 
-    @staticmethod
-    def fetch_cities(country):
-        data = requests.get(f"http://ezanvakti.herokuapp.com/sehirler/{country.id}").json()
+    def fetch_cities(self, country):
+        data = self.fetch(f"/sehirler/{country.id}")
         record = []
 
         if len(data) == 1:
             city_id = data[0]["SehirID"]
-            data = requests.get(f"http://ezanvakti.herokuapp.com/ilceler/{city_id}").json()
+            data = self.fetch(f"/ilceler/{city_id}")
 
             for rec in data:
                 record.append(
@@ -61,24 +298,37 @@ class Heroku(BaseProvider):
                 )
         return record
 
-    @staticmethod
-    def fetch_districts(city):
+    def district_index(self, city_id):
+        """District IDs of a province keyed by district key, fetched once."""
+        if city_id not in self._districts:
+            data = self.fetch(f"/ilceler/{city_id}")
+            self._districts[city_id] = {
+                rec["IlceAdiEn"].lower(): rec["IlceID"] for rec in data
+            }
+        return self._districts[city_id]
+
+    def fetch_districts(self, city):
+        """
+        Resolve the district whose timetable stands for the city.
+
+        The ID is stored on the city, so the district list is only
+        downloaded the first time a city is used.
+        """
         if city.direct_city_id:
             return city.id
+        if city.district_id:
+            return city.district_id
 
-        data = requests.get(f"http://ezanvakti.herokuapp.com/ilceler/{city.id}").json()
-        return list(filter(lambda x: x["IlceAdiEn"].lower() == city.city_key, data))[0]["IlceID"]
+        district_id = self.district_index(city.id).get(city.city_key)
+        if district_id is None:
+            raise ProviderError(f"{city.name}: no district {city.city_key}")
+        store_on_city(city, district_id=district_id)
+        return district_id
 
-    def get(self, today, city):
+    @staticmethod
+    def _record(times, next_day, today):
         tomorrow = today + timedelta(days=1)
-        data = requests.get(f"http://ezanvakti.herokuapp.com/vakitler?ilce={self.fetch_districts(city)}").json()
-        times = list(filter(lambda x: _date_parser(x["MiladiTarihKisa"]) == today, data))[0]
-        next_day = filter(
-            lambda x: _date_parser(x["MiladiTarihKisa"]) == today + timedelta(days=1),
-            data,
-        )
-        next_day = list(next_day)[0]
-        record = {
+        return {
             "sabah": (
                 _concat_date_time(times["Imsak"], today),
                 _concat_date_time(times["Gunes"], today),
@@ -104,11 +354,29 @@ class Heroku(BaseProvider):
                 _concat_date_time(next_day["Imsak"], tomorrow),
             ),
         }
-        return record
+
+    def get_range(self, start, end, city):
+        """
+        Parse every day of the vakitler payload, about a month from today.
+
+        A day is only returned when the payload also holds the next day,
+        whose Imsak closes yatsi and vitr.
+        """
+        data = self.fetch("/vakitler", {"ilce": self.fetch_districts(city)})
+        days = {_date_parser(rec["MiladiTarihKisa"]): rec for rec in data}
+        records = {}
+        for day, times in days.items():
+            next_day = days.get(day + timedelta(days=1))
+            if start <= day <= end and next_day:
+                records[day] = self._record(times, next_day, day)
+        return records
 
 
 class CollectApi(BaseProvider):
-    def __init__(self):
+    BASE_URL = "https://api.collectapi.com"
+
+    def __init__(self, transport=None, base_url=None):
+        super(CollectApi, self).__init__(transport, base_url)
         self.headers = {
             "content-type": "application/json",
             "authorization": "apikey 7lGnm6P6iiycQ9dvxj7z5K:1hxqBVW7UuNkM6X7fPHJGQ",
@@ -116,10 +384,9 @@ class CollectApi(BaseProvider):
 
     def get(self, today, city):
         tomorrow = today + timedelta(days=1)
-        conn = http.client.HTTPSConnection("api.collectapi.com")
-        conn.request("GET", "/pray/all?data.city={}".format(city.city_key), headers=self.headers)
-        res = conn.getresponse()
-        data = json.loads(res.read().decode("utf-8")).get("result")
+        data = self.fetch(
+            "/pray/all", {"data.city": city.city_key}, self.headers
+        ).get("result")
         if not data:
             raise IndexError
         times = dict(list(map(lambda x: list(x.values())[::-1], data)))
@@ -152,14 +419,18 @@ class CollectApi(BaseProvider):
         }
         return record
 
+    def get_range(self, start, end, city):
+        # The API only serves the current day.
+        return {start: self.get(start, city)}
+
 
 class Aladhan(BaseProvider):
-    def get(self, today, city):
+    BASE_URL = "https://api.aladhan.com"
+
+    @staticmethod
+    def _record(times, next_imsak, today):
         tomorrow = today + timedelta(days=1)
-        times = requests.get(
-            f"https://api.aladhan.com/v1/timingsByCity/{today}?city={city.name}&country={city.country.name}"
-        ).json()["data"]["timings"]
-        record = {
+        return {
             "sabah": (
                 _concat_date_time(times["Fajr"], today),
                 _concat_date_time(times["Sunrise"], today),
@@ -178,11 +449,264 @@ class Aladhan(BaseProvider):
             ),
             "yatsi": (
                 _concat_date_time(times["Isha"], today),
-                _concat_date_time(times["Imsak"], tomorrow),
+                _concat_date_time(next_imsak, tomorrow),
             ),
             "vitr": (
                 _concat_date_time(times["Isha"], today),
-                _concat_date_time(times["Imsak"], tomorrow),
+                _concat_date_time(next_imsak, tomorrow),
             ),
         }
-        return record
+
+    @staticmethod
+    def _locate(city, meta):
+        """Coordinates of meta the city does not know yet, else None."""
+        if city.latitude is None and meta:
+            return dict(
+                latitude=float(meta["latitude"]),
+                longitude=float(meta["longitude"]),
+                timezone=meta["timezone"],
+            )
+
+    def _keep_location(self, city, meta):
+        """Keep the city's coordinates for the Astronomical provider."""
+        coordinates = self._locate(city, meta)
+        if coordinates:
+            store_on_city(city, **coordinates)
+
+    def get(self, today, city):
+        data = self.fetch(
+            f"/v1/timingsByCity/{today}",
+            {"city": city.name, "country": city.country.name},
+        )["data"]
+        self._keep_location(city, data.get("meta"))
+        times = data["timings"]
+        return self._record(times, times["Imsak"], today)
+
+    def fetch_calendar(self, year, month, city):
+        data = self.fetch(
+            f"/v1/calendarByCity/{year}/{month}",
+            {"city": city.name, "country": city.country.name},
+        )["data"]
+        if data:
+            self._keep_location(city, data[0].get("meta"))
+        return {
+            datetime.strptime(rec["date"]["gregorian"]["date"], "%d-%m-%Y").date(): rec["timings"]
+            for rec in data
+        }
+
+    def get_range(self, start, end, city):
+        """One monthly calendar request per month touched by start..end+1."""
+        days = {}
+        month = start.replace(day=1)
+        while month <= end + timedelta(days=1):
+            days.update(self.fetch_calendar(month.year, month.month, city))
+            month = (month + timedelta(days=32)).replace(day=1)
+
+        records = {}
+        for day, times in days.items():
+            next_day = days.get(day + timedelta(days=1))
+            if start <= day <= end and next_day:
+                records[day] = self._record(times, next_day["Imsak"], day)
+        return records
+
+
+class Astronomical(BaseProvider):
+    """
+    Compute timetables locally from the city's coordinates and timezone.
+
+    A whole year is calculated in one batch (see astronomy.prayer_times)
+    and kept per location, so later ranges need neither network nor
+    math. The results approximate the published timetables, so this is
+    meant as the orchestrator's offline fallback. Cities without
+    coordinates raise ProviderError; Aladhan stores them the first time
+    it answers for the city. asr_factor 1 is Shafi'i, 2 Hanafi.
+    """
+
+    def __init__(self, method="Diyanet", asr_factor=1):
+        super(Astronomical, self).__init__()
+        self.method = method
+        self.asr_factor = asr_factor
+        self._years = {}
+
+    def calculate_year(self, year, city):
+        """
+        Timings of every day of year, plus the next January 1st, as
+        {day: {name: (day offset, "HH:MM") or None}}.
+        """
+        # NumPy is only loaded once a timetable is actually calculated.
+        from astronomy import format_times, prayer_times
+
+        key = (city.latitude, city.longitude, city.timezone, year)
+        if key not in self._years:
+            days, times = prayer_times(
+                date(year, 1, 1),
+                date(year + 1, 1, 1),
+                city.latitude,
+                city.longitude,
+                city.timezone,
+                self.method,
+                self.asr_factor,
+            )
+            columns = {name: format_times(hours) for name, hours in times.items()}
+            self._years[key] = {
+                day: {name: column[index] for name, column in columns.items()}
+                for index, day in enumerate(days)
+            }
+        return self._years[key]
+
+    @staticmethod
+    def _moment(day, timing):
+        offset, clock = timing
+        return _concat_date_time(clock, day + timedelta(days=offset))
+
+    def _record(self, times, next_day, today):
+        moment = self._moment
+        tomorrow = today + timedelta(days=1)
+        return {
+            "sabah": (moment(today, times["fajr"]), moment(today, times["sunrise"])),
+            "ogle": (moment(today, times["dhuhr"]), moment(today, times["asr"])),
+            "ikindi": (moment(today, times["asr"]), moment(today, times["maghrib"])),
+            "aksam": (moment(today, times["maghrib"]), moment(today, times["isha"])),
+            "yatsi": (moment(today, times["isha"]), moment(tomorrow, next_day["fajr"])),
+            "vitr": (moment(today, times["isha"]), moment(tomorrow, next_day["fajr"])),
+        }
+
+    def get_range(self, start, end, city):
+        """Days without a usable sunrise, sunset or fajr are left out."""
+        if city.latitude is None or not city.timezone:
+            raise ProviderError(f"{city.name}: coordinates unknown")
+
+        days = {}
+        for year in range(start.year, end.year + 1):
+            days.update(self.calculate_year(year, city))
+
+        records = {}
+        day = start
+        while day <= end:
+            times, next_day = days[day], days[day + timedelta(days=1)]
+            if None not in times.values() and next_day["fajr"] is not None:
+                records[day] = self._record(times, next_day, day)
+            day += timedelta(days=1)
+        return records
+
+
+class ProviderOrchestrator:
+    """
+    Ask several providers for a timetable concurrently.
+
+    Providers start in ranked order, the next one hedge_delay seconds
+    after the last unless an earlier one already failed. The first
+    non-empty answer wins and providers not yet started are not started;
+    requests already running cannot be interrupted, they finish in the
+    background and only count in the statistics. Latency and success of
+    every call are recorded and rank later calls: best success rate
+    first, then lowest average latency. The fallback, if any, is only
+    asked once every provider has failed.
+
+    call blocks until an answer; submit runs it off the Kivy main thread
+    and hands the result back on the main loop through Clock.
+    """
+
+    def __init__(self, providers, hedge_delay=HEDGE_DELAY, fallback=None):
+        self.providers = list(providers)
+        self.hedge_delay = hedge_delay
+        self.fallback = fallback
+        self.stats = {
+            self.name(provider): {"successes": 0, "failures": 0, "latency": None}
+            for provider in self.providers
+        }
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=len(self.providers), thread_name_prefix="provider"
+        )
+        self._calls = ThreadPoolExecutor(max_workers=2, thread_name_prefix="provider-call")
+
+    @staticmethod
+    def name(provider):
+        return provider.__class__.__name__
+
+    def ranked(self):
+        def score(provider):
+            stats = self.stats[self.name(provider)]
+            attempts = stats["successes"] + stats["failures"]
+            success_rate = (stats["successes"] + 1) / (attempts + 2)
+            return -success_rate, stats["latency"] or 0
+
+        with self._lock:
+            return sorted(self.providers, key=score)
+
+    def _record(self, provider, started, future):
+        stats = self.stats[self.name(provider)]
+        with self._lock:
+            if future.cancelled():
+                return
+            if future.exception() is None and future.result():
+                stats["successes"] += 1
+                latency = time.monotonic() - started
+                if stats["latency"] is None:
+                    stats["latency"] = latency
+                else:
+                    stats["latency"] = 0.7 * stats["latency"] + 0.3 * latency
+            else:
+                stats["failures"] += 1
+
+    def _submit(self, provider, method, args):
+        started = time.monotonic()
+        future = self._executor.submit(getattr(provider, method), *args)
+        future.add_done_callback(lambda done: self._record(provider, started, done))
+        return future
+
+    def call(self, method, *args):
+        waiting = self.ranked()
+        running = set()
+        errors = []
+        while waiting or running:
+            if waiting:
+                running.add(self._submit(waiting.pop(0), method, args))
+            done, running = wait(
+                running,
+                timeout=self.hedge_delay if waiting else None,
+                return_when=FIRST_COMPLETED,
+            )
+            for future in done:
+                if future.exception() is not None:
+                    errors.append(future.exception())
+                elif future.result():
+                    return future.result()
+        if self.fallback is not None:
+            try:
+                result = getattr(self.fallback, method)(*args)
+            except Exception as e:
+                errors.append(e)
+            else:
+                if result:
+                    return result
+        raise ProviderError(f"No provider answered {method}: {errors}")
+
+    def submit(self, method, *args, callback=None):
+        future = self._calls.submit(self.call, method, *args)
+        if callback is not None:
+            future.add_done_callback(
+                lambda done: Clock.schedule_once(lambda dt: self._deliver(done, callback))
+            )
+        return future
+
+    @staticmethod
+    def _deliver(future, callback):
+        try:
+            result = future.result()
+        except ProviderError as e:
+            Logger.warning(f"Providers: {e}")
+            return
+        callback(result)
+
+    def shutdown(self):
+        """Drop queued calls without waiting for the running requests."""
+        self._calls.shutdown(wait=False, cancel_futures=True)
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def get(self, today, city):
+        return self.call("get", today, city)
+
+    def get_range(self, start, end, city):
+        return self.call("get_range", start, end, city)
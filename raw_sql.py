@@ -1,55 +1,46 @@
-import os
-import sqlite3
-
 from dateutil.parser import parse
-from kivy import kivy_home_dir
+
+from storage import SQLiteDB
 
 
 def full_prayed_dates(max_date=False, min_date=False):
-    conn = sqlite3.connect(os.path.join(kivy_home_dir, 'kivypraying.sqlite3'))
     sql = """
-        select date, count('id')
-        from praying_status 
-        where is_prayed
-        group by date
-        having count('id') = 6
+        select date
+        from daily_summary
+        where is_complete = 1
     """
     if min_date:
         sql += """
-        order by praying_status.date
+        order by date
         limit 1
         """
     elif max_date:
         sql += """
-        order by praying_status.date desc
+        order by date desc
         limit 1
         """
 
-    cursor = conn.cursor()
+    cursor = SQLiteDB.conn.cursor()
     cursor.execute(sql)
     data = cursor.fetchone()
     return parse(data[0]).date()
 
 
 def fetch_missing_prays(start_date, end_date):
-    conn = sqlite3.connect(os.path.join(kivy_home_dir, 'kivypraying.sqlite3'))
-    sql = f"""
-        select date, sum(is_prayed)
-        from praying_status
-        where date >= '{start_date}' and date <= '{end_date}'
-        group by date
-        having sum(is_prayed) < 6
+    sql = """
+        select count(*)
+        from daily_summary
+        where is_complete = 0 and date between ? and ?
     """
 
-    cursor = conn.cursor()
-    cursor.execute(sql)
-    data = cursor.fetchall()
-    return len(data)
+    cursor = SQLiteDB.conn.cursor()
+    cursor.execute(sql, (str(start_date), str(end_date)))
+    return cursor.fetchone()[0]
 
 
 def check_none():
-    conn = sqlite3.connect(os.path.join(kivy_home_dir, 'kivypraying.sqlite3'))
-    cursor = conn.cursor()
-    cursor.execute("update praying_status set is_prayed=false where is_prayed is null")
-    cursor.execute("delete from praying_status where time_name='imsak'")
-    conn.commit()
+    with SQLiteDB.transaction():
+        cursor = SQLiteDB.conn.cursor()
+        cursor.execute("update praying_status set is_prayed=false where is_prayed is null")
+        cursor.execute("delete from praying_status where time_name='imsak'")
+        SQLiteDB.mark_written("praying_status")
@@ -0,0 +1,90 @@
+from datetime import datetime, timedelta
+
+from dateutil.relativedelta import relativedelta
+from kivy.clock import Clock
+
+from models import Reward
+from raw_sql import full_prayed_dates, fetch_missing_prays
+from storage import SQLiteDB
+
+REWARDS = ("yearly", "monthly", "weekly", "daily")
+
+
+def calculate_rewards():
+    """Reward counts of the longest run of fully prayed days."""
+    try:
+        start_date = full_prayed_dates(min_date=True)
+        end_date = full_prayed_dates(max_date=True)
+        missing_between = fetch_missing_prays(start_date, end_date)
+        end_date -= timedelta(days=missing_between)
+        time_difference = relativedelta(end_date, start_date)
+        return {
+            "yearly": time_difference.years,
+            "monthly": time_difference.months,
+            "weekly": int(time_difference.days / 7),
+            "daily": time_difference.days % 7,
+        }
+    except TypeError:
+        return dict.fromkeys(REWARDS, 0)
+
+
+class RewardEngine:
+    """
+    Keep the reward counts in step with praying_status.
+
+    Counts live in memory and are recalculated only when a status write
+    is committed or the day rolls over; a change is stored with one
+    write and reported to on_reward with the names of rewards gained,
+    ordered as REWARDS.
+    """
+
+    def __init__(self, on_reward=None):
+        self.on_reward = on_reward
+        self.counts = {}
+        self._pks = {}
+        self._refresh_event = None
+        self._rollover_event = None
+
+    def start(self):
+        for reward in Reward.list():
+            self.counts[reward.name] = reward.count
+            self._pks[reward.name] = reward.pk
+        SQLiteDB.subscribe("praying_status", self._status_changed)
+        self.refresh()
+        self._schedule_rollover()
+
+    def stop(self):
+        SQLiteDB.unsubscribe("praying_status", self._status_changed)
+        for event in (self._refresh_event, self._rollover_event):
+            if event is not None:
+                event.cancel()
+
+    def _status_changed(self, table):
+        # May run on a storage thread; coalesce bursts into one refresh.
+        if self._refresh_event is None:
+            self._refresh_event = Clock.schedule_once(lambda dt: self.refresh())
+
+    def _schedule_rollover(self):
+        now = datetime.now()
+        midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+        self._rollover_event = Clock.schedule_once(
+            self._rollover, (midnight - now).total_seconds() + 1
+        )
+
+    def _rollover(self, dt):
+        self.refresh()
+        self._schedule_rollover()
+
+    def refresh(self):
+        self._refresh_event = None
+        counts = calculate_rewards()
+        if counts == {name: self.counts.get(name) for name in REWARDS}:
+            return
+
+        gained = [name for name in REWARDS if counts[name] > self.counts.get(name, 0)]
+        self.counts.update(counts)
+        Reward.update_bulk(
+            [{"pk": self._pks[name], "count": counts[name]} for name in REWARDS]
+        )
+        if gained and self.on_reward:
+            self.on_reward(gained)
@@ -0,0 +1,108 @@
+from bisect import bisect_right
+from datetime import datetime, timedelta
+
+from kivy.clock import Clock
+
+# Seconds between countdown ticks.
+TICK = 1
+# Seconds past an instant before its transition fires, so comparisons
+# against the boundary already see it as passed.
+MARGIN = 0.05
+
+
+class DayScheduler:
+    """
+    Drive the day's UI from its timetable instead of polling loops.
+
+    load() builds the sorted timeline of prayer starts and ends plus the
+    next midnight; only one Clock event waits for the next instant, where
+    on_transition runs, or on_day_change once the date has rolled over.
+    on_tick gets the current time every TICK seconds for the countdown.
+    """
+
+    def __init__(self, on_transition=None, on_day_change=None, on_tick=None):
+        self.on_transition = on_transition
+        self.on_day_change = on_day_change
+        self.on_tick = on_tick
+        self.day = None
+        self.timeline = []
+        self._event = None
+        self._tick_event = None
+
+    def load(self, times):
+        self.day = datetime.now().date()
+        midnight = datetime.combine(self.day + timedelta(days=1), datetime.min.time())
+        instants = {midnight}
+        for time in times:
+            instants.update((time.from_time, time.to_time))
+        self.timeline = sorted(instants)
+        self._schedule_next()
+        if self._tick_event is None:
+            self._tick_event = Clock.schedule_interval(self._tick, TICK)
+
+    def stop(self):
+        for event in (self._event, self._tick_event):
+            if event is not None:
+                event.cancel()
+        self._event = self._tick_event = None
+
+    def _schedule_next(self):
+        if self._event is not None:
+            self._event.cancel()
+        now = datetime.now()
+        index = bisect_right(self.timeline, now)
+        if index == len(self.timeline):
+            self._event = None
+            return
+        delay = (self.timeline[index] - now).total_seconds() + MARGIN
+        self._event = Clock.schedule_once(self._fire, delay)
+
+    def _fire(self, dt):
+        self._event = None
+        if datetime.now().date() != self.day:
+            if self.on_day_change:
+                self.on_day_change()
+        elif self.on_transition:
+            self.on_transition()
+        if self._event is None:
+            self._schedule_next()
+
+    def _tick(self, dt):
+        if self.on_tick:
+            self.on_tick(datetime.now())
+
+
+class Countdown:
+    """
+    Seconds left to the next prayer boundary, precomputed for the day.
+
+    Starts and ends are kept as sorted epoch seconds; the next one is
+    found by bisect. update() returns the H/M/S strings only for the
+    parts that changed since the last call.
+    """
+
+    def __init__(self, times):
+        self.boundaries = sorted(
+            {
+                int(moment.timestamp())
+                for time in times
+                for moment in (time.from_time, time.to_time)
+            }
+        )
+        self._shown = (None, None, None)
+
+    def remaining(self, now):
+        index = bisect_right(self.boundaries, now)
+        if index == len(self.boundaries):
+            return 0
+        return self.boundaries[index] - now
+
+    def update(self, now):
+        minutes, seconds = divmod(self.remaining(int(now)), 60)
+        hours, minutes = divmod(minutes, 60)
+        shown = (f"{hours:02d}", f"{minutes:02d}", f"{seconds:02d}")
+        changed = tuple(
+            new if new != old else None for new, old in zip(shown, self._shown)
+        )
+        self._shown = shown
+        return changed
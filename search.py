@@ -0,0 +1,80 @@
+import unicodedata
+
+# Letters folded before lowercasing: str.lower maps "İ" to "i" plus a
+# combining dot, and the dotless "ı" has no ASCII decomposition.
+TURKISH_FOLD = str.maketrans({"İ": "i", "I": "i", "ı": "i"})
+GRAM_SIZE = 3
+
+
+def normalize(text):
+    """Fold case and Turkish diacritics so "Şanlıurfa" matches "sanliurfa"."""
+    text = unicodedata.normalize("NFKD", text.translate(TURKISH_FOLD).lower())
+    return "".join(char for char in text if not unicodedata.combining(char))
+
+
+def grams(text):
+    padded = f" {text} "
+    return {padded[i:i + GRAM_SIZE] for i in range(len(padded) - GRAM_SIZE + 1)}
+
+
+class SearchIndex(object):
+    """
+    Search-as-you-type index over a list of names.
+
+    Every prefix of every word maps to the names holding it, and trigrams
+    of the whole name catch infix matches and typos. Results are ranked
+    exact match, name prefix, word prefix, substring, then trigram
+    overlap; more shared trigrams and shorter names first within a rank.
+    """
+
+    def __init__(self, names):
+        self.names = list(names)
+        self.keys = [normalize(name) for name in self.names]
+        self._prefixes = {}
+        self._grams = {}
+        for index, key in enumerate(self.keys):
+            for word in key.split():
+                for end in range(1, len(word) + 1):
+                    self._prefixes.setdefault(word[:end], set()).add(index)
+            for gram in grams(key):
+                self._grams.setdefault(gram, set()).add(index)
+
+    def _rank(self, index, query, overlap):
+        key = self.keys[index]
+        if key == query:
+            rank = 0
+        elif key.startswith(query):
+            rank = 1
+        elif all(
+            any(word.startswith(part) for word in key.split()) for part in query.split()
+        ):
+            rank = 2
+        elif query in key:
+            rank = 3
+        else:
+            rank = 4
+        return rank, -overlap.get(index, 0), len(key), key
+
+    def search(self, query, limit=None):
+        query = " ".join(normalize(query).split())
+        if not query:
+            return self.names[:limit]
+
+        counts = {}
+        candidates = None
+        for part in query.split():
+            matches = self._prefixes.get(part, set())
+            candidates = matches if candidates is None else candidates & matches
+
+        if not candidates:
+            query_grams = grams(query)
+            for gram in query_grams:
+                for index in self._grams.get(gram, ()):
+                    counts[index] = counts.get(index, 0) + 1
+            # Half of the query's trigrams tolerate about one typo per
+            # three letters without matching unrelated names.
+            threshold = max(1, len(query_grams) // 2)
+            candidates = {index for index, count in counts.items() if count >= threshold}
+
+        ranked = sorted(candidates, key=lambda index: self._rank(index, query, counts))
+        return [self.names[index] for index in ranked[:limit]]
@@ -4,11 +4,17 @@ from kivy.metrics import sp
 from kivy.properties import ListProperty, BooleanProperty, ObjectProperty
 from kivy.uix.behaviors import ButtonBehavior
 from kivy.uix.dropdown import DropDown
+from kivy.uix.textinput import TextInput
 from kivy.utils import get_color_from_hex
 
-from config import set_children_color, find_parent
+from config import set_children_color, set_color, find_parent
 from main import trans, RoundedLabel
 from models import Language, City, Country
+from search import SearchIndex
+from storage import SQLiteDB, SQLiteDBAsync
+
+# Options listed at once while a search query is typed.
+SEARCH_LIMIT = 30
 
 
 class SpinnerOption(ButtonBehavior, RoundedLabel):
@@ -108,6 +114,66 @@ class CustomSpinner(ButtonBehavior, RoundedLabel):
                 self._dropdown.dismiss()
 
 
+class SearchSpinner(CustomSpinner):
+    """
+    Spinner whose dropdown starts with a search box.
+
+    Options are filtered on every keystroke through a SearchIndex built
+    once per values list, i.e. once per country for cities.
+    """
+
+    def __init__(self, **kwargs):
+        self._index = None
+        self._options = []
+        self._search = TextInput(
+            multiline=False, size_hint_y=None, height=sp(30), font_size=sp(15)
+        )
+        super(SearchSpinner, self).__init__(**kwargs)
+        self._search.bind(text=self._filter)
+
+    def _update_dropdown(self, *largs):
+        if self._index is None or self._index.names != self.values:
+            self._index = SearchIndex(self.values)
+        dp = self._dropdown
+        dp.clear_widgets()
+        self._options = []
+        if self._search.parent:
+            self._search.parent.remove_widget(self._search)
+        dp.add_widget(self._search)
+        self._show(self._index.search(self._search.text))
+        self.set_text()
+        if self.text_autoupdate:
+            if self.values:
+                if not self.text or self.text not in self.values:
+                    self.text = self.values[0]
+            else:
+                self.text = ""
+
+    def _filter(self, instance, text):
+        self._show(self._index.search(text, limit=SEARCH_LIMIT if text else None))
+
+    def _show(self, values):
+        dp = self._dropdown
+        cls = self.option_cls
+        if isinstance(cls, string_types):
+            cls = Factory.get(cls)
+        for item in self._options:
+            dp.remove_widget(item)
+        self._options = []
+        for value in values:
+            item = cls(text=value, font_size=sp(15), halign="center")
+            item.height = sp(30)
+            item.bind(on_release=lambda option: dp.select(option.text))
+            dp.add_widget(item)
+            set_color(item, get_color_from_hex("D2D1BE"))
+            self._options.append(item)
+
+    def on_is_open(self, instance, value):
+        if value:
+            self._search.text = ""
+        super(SearchSpinner, self).on_is_open(instance, value)
+
+
 class LangSpinner(CustomSpinner):
     values_dict = {"Türkçe": "tr", "English": "en"}
 
@@ -130,7 +196,7 @@ class LangSpinner(CustomSpinner):
         root.switch_lang(self.values_dict.get(data))
 
 
-class CitySpinner(CustomSpinner):
+class CitySpinner(SearchSpinner):
     def __init__(self, **kwargs):
         super(CitySpinner, self).__init__(**kwargs)
         country = Country.get(selected=True)
@@ -142,17 +208,15 @@ class CitySpinner(CustomSpinner):
         self.text = City.get(selected=True).name
 
     def _on_dropdown_select(self, instance, data, *largs):
-        from main import Praying
-
         super(CitySpinner, self)._on_dropdown_select(
             instance=instance, data=data, *largs
         )
-        root = find_parent(self, Praying)
+        SQLiteDBAsync.write(City.select_only, name=data, callback=self._reload)
 
-        for city in City.list():
-            selected = city.name == data
-            City.update(city, selected=selected)
+    def _reload(self, *largs):
+        from main import Praying
 
+        root = find_parent(self, Praying)
         root.welcome.progressbar.value = 0
 
         root.progressbar_path(
@@ -163,8 +227,8 @@ class CitySpinner(CustomSpinner):
                         root.fetch_selected_country,
                         root.fetch_selected_city,
                         root.fetch_today_praying_times,
-                        root.check_praying_status,
                         root.reset_missed_prays,
+                        root.check_praying_status,
                         root.check_missed_prays(),
                     ]
                 )
@@ -173,7 +237,7 @@ class CitySpinner(CustomSpinner):
         )
 
 
-class CountrySpinner(CustomSpinner):
+class CountrySpinner(SearchSpinner):
     def __init__(self, **kwargs):
         super(CountrySpinner, self).__init__(**kwargs)
         self.values = sorted(list(map(lambda x: x.name, Country.list())))
@@ -182,22 +246,22 @@ class CountrySpinner(CustomSpinner):
         self.text = Country.get(selected=True).name
 
     def _on_dropdown_select(self, instance, data, *largs):
-        from main import Praying
-
         super(CountrySpinner, self)._on_dropdown_select(
             instance=instance, data=data, *largs
         )
-        root = find_parent(self, Praying)
+        SQLiteDBAsync.write(self._select, data, callback=self._reload)
+
+    @staticmethod
+    def _select(name):
+        with SQLiteDB.transaction():
+            Country.select_only(name=name)
+            City.update_where({"selected": True}, selected=False)
 
-        for country in Country.list():
-            selected = country.name == data
-            Country.update(country, selected=selected)
-            cities = City.list(selected=True)
-            for city in cities:
-                City.update(city, selected=False)
+    def _reload(self, *largs):
+        from main import Praying
 
+        root = find_parent(self, Praying)
         root.welcome.progressbar.value = 0
-        country = Country.get(selected=True)
         root.progressbar_path(
             path=list(
                 reversed(
@@ -207,8 +271,8 @@ class CountrySpinner(CustomSpinner):
                         root.fetch_cities,
                         root.fetch_selected_city,
                         root.fetch_today_praying_times,
-                        root.check_praying_status,
                         root.reset_missed_prays,
+                        root.check_praying_status,
                         root.check_missed_prays(),
                     ]
                 )
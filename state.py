@@ -0,0 +1,61 @@
+from models import Status
+
+PRAYED = "prayed"
+MISSED = "missed"
+UPCOMING = "upcoming"
+OPEN = "open"
+
+
+class DayState:
+    """
+    Today's praying statuses held in memory.
+
+    Statuses are loaded once; marking a prayer through mark_prayed writes
+    it and keeps the copy current. diff() reports only the prayers whose
+    state changed since the previous call, so callers touch just those
+    widgets.
+    """
+
+    def __init__(self, today, times):
+        self.today = today
+        self.times = {time.time_name: time for time in times}
+        self.statuses = {
+            status.time_name: status for status in Status.list(date=today)
+        }
+        self._shown = {}
+
+    def state(self, time_name, now):
+        status = self.statuses.get(time_name)
+        time = self.times[time_name]
+        if status is not None and status.is_prayed:
+            return PRAYED
+        elif now > time.to_time:
+            return MISSED
+        elif now < time.from_time:
+            return UPCOMING
+        return OPEN
+
+    def diff(self, now):
+        changes = {}
+        for time_name in self.times:
+            state = self.state(time_name, now)
+            if self._shown.get(time_name) != state:
+                changes[time_name] = self._shown[time_name] = state
+        return changes
+
+    def redraw(self, state=None):
+        """Report prayers in state (or all) as changed on the next diff."""
+        for time_name, shown in list(self._shown.items()):
+            if state is None or shown == state:
+                del self._shown[time_name]
+
+    def mark_prayed(self, time_name):
+        status = self.statuses[time_name]
+        Status.update(status, is_prayed=True)
+        status.is_prayed = True
+
+    def status_prayed(self, status):
+        """Record a write made elsewhere, e.g. from the missed list."""
+        mine = self.statuses.get(status.time_name)
+        if mine is not None and mine.pk == status.pk:
+            mine.is_prayed = True
@@ -1,167 +1,579 @@
 import os
 import sqlite3
-from copy import copy
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, date
 
 from kivy import kivy_home_dir
+from kivy.clock import Clock
+from kivy.logger import Logger
 
-from migrations import STATEMENTS
+from migrations import migrate
+
+STATEMENT_CACHE_SIZE = 256
+# Opt-in pragmas applied when the connection opens, e.g. "wal" and "normal".
+# None keeps SQLite's defaults (rollback journal, synchronous=full).
+JOURNAL_MODE = None
+SYNCHRONOUS = None
+LOOKUPS = {
+    "": "=",
+    "ne": "<>",
+    "lt": "<",
+    "lte": "<=",
+    "gt": ">",
+    "gte": ">=",
+}
+# Cached query results kept per table before that table's cache is reset.
+QUERY_CACHE_SIZE = 512
+
+
+_MISSING = object()
+
+
+class ConnectionManager:
+    """
+    Hand out one SQLite connection per thread.
+
+    Connections are opened lazily, get their pragmas once when opened and
+    are all closed together by close().
+    """
+
+    def __init__(self, path, journal_mode=None, synchronous=None):
+        self.path = path
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+
+    @property
+    def conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._open()
+        return conn
+
+    def _open(self):
+        conn = sqlite3.connect(
+            self.path,
+            cached_statements=STATEMENT_CACHE_SIZE,
+            check_same_thread=False
+        )
+        if self.journal_mode:
+            conn.execute(f"PRAGMA journal_mode={self.journal_mode}")
+        if self.synchronous:
+            conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+    def close(self):
+        """Close every connection opened by any thread."""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
 
 
 class SQLiteStore:
-    def __init__(self):
-        self.conn = sqlite3.connect(os.path.join(kivy_home_dir, 'kivypraying.sqlite3'))
-        for statement in STATEMENTS:
-            try:
-                c = self.conn.cursor()
-                c.execute(statement)
-                self.conn.commit()
-            except Exception as e:
-                pass
+    def __init__(self, journal_mode=None, synchronous=None):
+        self.connections = ConnectionManager(
+            os.path.join(kivy_home_dir, 'kivypraying.sqlite3'),
+            journal_mode=journal_mode,
+            synchronous=synchronous
+        )
+        self._local = threading.local()
+        self._statements = {}
+        self._query_cache = {}
+        self._identity_map = {}
+        self._generations = {}
+        self._epoch = 0
+        self._cache_lock = threading.Lock()
+        self._listeners = {}
+        self._dependents = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        migrate(self.conn)
+
+    @property
+    def conn(self):
+        return self.connections.conn
+
+    @property
+    def _transaction_depth(self):
+        return getattr(self._local, "depth", 0)
+
+    @_transaction_depth.setter
+    def _transaction_depth(self, value):
+        self._local.depth = value
+
+    def close(self):
+        self.connections.close()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Group writes into one unit of work.
+
+        create/update/delete calls inside the block skip their own commit,
+        the outermost block commits once on exit or rolls back on error.
+        """
+        self._transaction_depth += 1
+        try:
+            yield self
+        except Exception:
+            self._transaction_depth -= 1
+            if not self._transaction_depth:
+                self.conn.rollback()
+                self._local.dirty = set()
+                self.invalidate()
+            raise
+        self._transaction_depth -= 1
+        if not self._transaction_depth:
+            self._commit()
+
+    def add_dependency(self, table, depends_on):
+        """Invalidate table whenever depends_on is written, e.g. by triggers."""
+        self._dependents.setdefault(depends_on, set()).add(table)
+
+    def invalidate(self, table=None):
+        """Drop cached rows of a table, or of every table when none given."""
+        with self._cache_lock:
+            if table is None:
+                self._query_cache.clear()
+                self._identity_map.clear()
+                self._epoch += 1
+                return
+            for name in (table, *self._dependents.get(table, ())):
+                self._query_cache.pop(name, None)
+                self._identity_map.pop(name, None)
+                self._generations[name] = self._generations.get(name, 0) + 1
+
+    def _cached(self, model, key):
+        """Return the cached result, or _MISSING plus the cache generation."""
+        table = model.Meta.db_name
+        with self._cache_lock:
+            generation = (self._epoch, self._generations.get(table, 0))
+            result = self._query_cache.get(table, {}).get(key, _MISSING)
+        if result is _MISSING:
+            self.cache_misses += 1
+        else:
+            self.cache_hits += 1
+        return result, generation
+
+    def _remember(self, model, key, result, generation):
+        """Cache a result unless the table was written since it was read."""
+        table = model.Meta.db_name
+        with self._cache_lock:
+            if generation != (self._epoch, self._generations.get(table, 0)):
+                return
+            table_cache = self._query_cache.setdefault(table, {})
+            if len(table_cache) >= QUERY_CACHE_SIZE:
+                table_cache.clear()
+            table_cache[key] = result
+
+    def mark_written(self, table):
+        """
+        Record a write to table and commit it outside of a transaction.
+
+        The cache is dropped again after the commit, so readers on other
+        threads cannot cache rows read between the write and the commit.
+        """
+        self.invalidate(table)
+        dirty = getattr(self._local, "dirty", None)
+        if dirty is None:
+            dirty = self._local.dirty = set()
+        dirty.add(table)
+        if not self._transaction_depth:
+            self._commit()
+
+    def _hydrate(self, model, description, data, generation):
+        """
+        Build model instances, reusing the one mapped to each pk when its
+        row is unchanged.
+
+        New instances are only mapped while the table generation still
+        matches the one read before the select, so rows read before a
+        write cannot be put back into the map after it.
+        """
+        table = model.Meta.db_name
+        pk_index = description.index("pk")
+        with self._cache_lock:
+            identities = self._identity_map.get(table)
+            known = identities and [identities.get(row[pk_index]) for row in data]
+
+        hydrate = model.hydrator(description)
+        if not known:
+            result = [hydrate(row) for row in data]
+            fresh = [
+                (row[pk_index], (description, row, instance))
+                for row, instance in zip(data, result)
+            ]
+        else:
+            result = []
+            fresh = []
+            for row, entry in zip(data, known):
+                if (
+                    entry is not None
+                    and entry[1] == row
+                    and entry[0] == description
+                    and entry[2].__class__ is model
+                ):
+                    result.append(entry[2])
+                    continue
+                instance = hydrate(row)
+                fresh.append((row[pk_index], (description, row, instance)))
+                result.append(instance)
+
+        if fresh:
+            with self._cache_lock:
+                if generation == (self._epoch, self._generations.get(table, 0)):
+                    self._identity_map.setdefault(table, {}).update(fresh)
+        return result
+
+    def _commit(self):
+        self.conn.commit()
+        dirty = getattr(self._local, "dirty", ())
+        self._local.dirty = set()
+        for table in dirty:
+            self.invalidate(table)
+        for table in dirty:
+            for callback in self._listeners.get(table, ()):
+                callback(table)
+
+    def subscribe(self, table, callback):
+        """
+        Call callback(table) after every committed write to table.
+
+        Callbacks run on the writing thread; UI code should hop to the
+        main loop through Clock.
+        """
+        self._listeners.setdefault(table, []).append(callback)
+
+    def unsubscribe(self, table, callback):
+        if callback in self._listeners.get(table, ()):
+            self._listeners[table].remove(callback)
+
+    @staticmethod
+    def _db_value(attr_type, value):
+        if value is None:
+            return None
+        elif attr_type in (date, datetime, str):
+            return str(value)
+        elif attr_type == bool:
+            return int(bool(value))
+        return value
 
     @staticmethod
     def _fetch_attr_clause(model, **kwargs):
-        where_clause = []
+        """
+        Split lookups into a hashable clause signature and its parameters.
 
+        The signature only depends on the field names, operators and the
+        number of values bound, so every call with the same shape shares
+        one SQL text.
+        """
         prep = {}
         for key, value in kwargs.items():
             key_parts = key.split("__", 1)
             field = key_parts[0]
             ext = ''.join(key_parts[1:])
 
-            prep[field] = {"value": value, "ext": ext}
+            prep.setdefault(field, []).append({"value": value, "ext": ext})
 
+        signature = []
+        params = []
         for key, attr_type in model.__annotations__.items():
-            if key not in prep:
-                continue
-
-            value = prep.get(key, {}).get("value")
-            ext = prep.get(key, {}).get("ext")
-
-            if value is None:
-                where_clause.append(f"{key} is null")
-                continue
-            elif attr_type in (date, datetime, str):
-                value = f"'{value}'"
-            elif attr_type == bool:
-                value = bool(value)
-
-            if ext == "ne":
-                where_clause.append(f'{key}<>{value}')
+            for lookup in prep.get(key, []):
+                value = lookup["value"]
+                ext = lookup["ext"]
+
+                if value is None:
+                    signature.append((key, ext, 0))
+                    continue
+                elif ext in ("in", "between"):
+                    values = [SQLiteStore._db_value(attr_type, x) for x in value]
+                elif ext in LOOKUPS:
+                    values = [SQLiteStore._db_value(attr_type, value)]
+                else:
+                    raise ValueError(f"Unsupported lookup: {key}__{ext}")
+
+                signature.append((key, ext, len(values)))
+                params.extend(values)
+
+        return tuple(signature), params
+
+    @staticmethod
+    def _where_sql(signature):
+        where_clause = []
+        for key, ext, arity in signature:
+            if not arity and ext != "in":
+                where_clause.append(f"{key} is {'not ' if ext == 'ne' else ''}null")
+            elif ext == "in":
+                where_clause.append(f"{key} in ({','.join('?' * arity)})")
+            elif ext == "between":
+                where_clause.append(f"{key} between ? and ?")
             else:
-                where_clause.append(f'{key}={value}')
+                where_clause.append(f"{key}{LOOKUPS[ext]}?")
 
         if not where_clause:
             where_clause = ['1=1']
 
-        return where_clause
+        return ' and '.join(where_clause)
+
+    @staticmethod
+    def _query_options(model, kwargs):
+        """
+        Pop order_by, limit and offset out of the lookups.
+
+        Returns their signature for the statement cache and the parameters
+        bound after the where clause.
+        """
+        order_by = kwargs.pop("order_by", ())
+        if isinstance(order_by, str):
+            order_by = (order_by,)
+        for field in order_by:
+            if field.lstrip("-") not in model.__annotations__:
+                raise ValueError(f"Unknown order_by field: {field}")
+
+        params = []
+        limit = kwargs.pop("limit", None)
+        offset = kwargs.pop("offset", None)
+        if limit is not None or offset is not None:
+            params.append(-1 if limit is None else limit)
+        if offset is not None:
+            params.append(offset)
+
+        return (tuple(order_by), bool(params), offset is not None), params
+
+    @staticmethod
+    def _options_sql(options):
+        order_by, has_limit, has_offset = options
+        sql = ""
+        if order_by:
+            sql += " order by " + ", ".join(
+                f"{field[1:]} desc" if field.startswith("-") else field
+                for field in order_by
+            )
+        if has_limit:
+            sql += " limit ?"
+        if has_offset:
+            sql += " offset ?"
+        return sql
+
+    def _statement(self, model, operation, signature, set_fields=(), options=None):
+        """Return the cached SQL text for an operation on a clause signature."""
+        key = (model, operation, signature, set_fields, options)
+        sql = self._statements.get(key)
+        if sql is None:
+            where = self._where_sql(signature)
+            if operation == "select":
+                sql = f"select * from {model.Meta.db_name} where {where}"
+                sql += self._options_sql(options)
+            elif operation == "aggregate":
+                sql = f"select {set_fields[0]} from {model.Meta.db_name} where {where}"
+            elif operation == "exists":
+                sql = f"select exists(select 1 from {model.Meta.db_name} where {where})"
+            elif operation == "delete":
+                sql = f"delete from {model.Meta.db_name} where {where}"
+            elif operation == "update":
+                sql = "update {} set {} where pk=?".format(
+                    model.Meta.db_name,
+                    ', '.join(f"{field}=?" for field in set_fields)
+                )
+            elif operation == "update_where":
+                sql = "update {} set {} where {}".format(
+                    model.Meta.db_name,
+                    ', '.join(f"{field}=?" for field in set_fields),
+                    where
+                )
+            elif operation == "select_only":
+                sql = "update {} set {field}=coalesce(({}), 0)".format(
+                    model.Meta.db_name, where, field=set_fields[0]
+                )
+            elif operation == "insert":
+                sql = "insert into {} ({}) values ({})".format(
+                    model.Meta.db_name,
+                    ','.join(set_fields),
+                    ','.join('?' * len(set_fields))
+                )
+            if len(self._statements) >= STATEMENT_CACHE_SIZE:
+                # Drop the oldest text; callers with unusual shapes cannot
+                # grow the cache without bound.
+                self._statements.pop(next(iter(self._statements)), None)
+            self._statements[key] = sql
+        return sql
 
     def retrieve(self, model, **kwargs):
-        where_clause = self._fetch_attr_clause(model, **kwargs)
+        options, option_params = self._query_options(model, kwargs)
+        signature, params = self._fetch_attr_clause(model, **kwargs)
+        params += option_params
+        cache_key = ("retrieve", model, signature, options, tuple(params))
+        result, generation = self._cached(model, cache_key)
+        if result is not _MISSING:
+            return result
 
         c = self.conn.cursor()
-        c.execute("select * from {} where {}".format(
-            model.Meta.db_name,
-            ' and '.join(where_clause)
-        ))
+        c.execute(self._statement(model, "select", signature, options=options), params)
         data_set = c.fetchone()
-        description = list(map(lambda x: x[0], c.description))
+        description = tuple(map(lambda x: x[0], c.description))
+        result = None
         if data_set:
-            return model(**dict(list(zip(description, data_set))))
-        return None
+            result = self._hydrate(model, description, (data_set,), generation)[0]
+        self._remember(model, cache_key, result, generation)
+        return result
 
     def list(self, model, **kwargs):
-        result = []
-        where_clause = self._fetch_attr_clause(model, **kwargs)
+        options, option_params = self._query_options(model, kwargs)
+        signature, params = self._fetch_attr_clause(model, **kwargs)
+        params += option_params
+        cache_key = ("list", model, signature, options, tuple(params))
+        result, generation = self._cached(model, cache_key)
+        if result is not _MISSING:
+            return list(result)
 
         c = self.conn.cursor()
-        c.execute("select * from {} where {}".format(
-            model.Meta.db_name,
-            ' and '.join(where_clause)
-        ))
-
-        data = c.fetchall()
-        description = list(map(lambda x: x[0], c.description))
-        for data_set in data:
-            tmp = list(zip(description, data_set))
-            result.append(model(**dict(tmp)))
+        c.execute(self._statement(model, "select", signature, options=options), params)
+
+        description = tuple(map(lambda x: x[0], c.description))
+        result = self._hydrate(model, description, c.fetchall(), generation)
+        self._remember(model, cache_key, tuple(result), generation)
         return result
 
+    def aggregate(self, model, function, field="*", **kwargs):
+        """Return count/min/max of a field over the rows matching kwargs."""
+        if field != "*" and field not in model.__annotations__:
+            raise ValueError(f"Unknown field: {field}")
+        signature, params = self._fetch_attr_clause(model, **kwargs)
+        expression = f"{function}({field})"
+        cache_key = ("aggregate", model, expression, signature, tuple(params))
+        result, generation = self._cached(model, cache_key)
+        if result is not _MISSING:
+            return result
+
+        c = self.conn.cursor()
+        c.execute(self._statement(model, "aggregate", signature, (expression,)), params)
+        result = c.fetchone()[0]
+        self._remember(model, cache_key, result, generation)
+        return result
+
+    def exists(self, model, **kwargs):
+        signature, params = self._fetch_attr_clause(model, **kwargs)
+        cache_key = ("exists", model, signature, tuple(params))
+        result, generation = self._cached(model, cache_key)
+        if result is not _MISSING:
+            return result
+
+        c = self.conn.cursor()
+        c.execute(self._statement(model, "exists", signature), params)
+        result = bool(c.fetchone()[0])
+        self._remember(model, cache_key, result, generation)
+        return result
+
+    def _insert_fields(self, model):
+        return tuple(key for key in model.__annotations__ if key != 'pk')
+
     def create(self, model, **kwargs):
-        values = []
-        keys = []
-        for key, attr_type in model.__annotations__.items():
-            if key == 'pk':
-                continue
-            keys.append(key)
-            value = kwargs.get(key)
-            if value is None:
-                value = 'null'
-            elif attr_type in (date, datetime, str):
-                value = "'{}'".format(value)
-            elif attr_type == bool:
-                value = bool(value)
-            values.append(value)
+        keys = self._insert_fields(model)
+        values = [
+            self._db_value(model.__annotations__[key], kwargs.get(key))
+            for key in keys
+        ]
 
         c = self.conn.cursor()
-        c.execute(
-            "insert into {} ({}) values ({})".format(
-                model.Meta.db_name,
-                ','.join(map(str, keys)),
-                ','.join(map(str, values))
-            )
-        )
-        self.conn.commit()
+        c.execute(self._statement(model, "insert", (), keys), values)
+        self.mark_written(model.Meta.db_name)
 
     def create_bulk(self, model, **kwargs):
+        keys = self._insert_fields(model)
         values = []
-        keys = []
-        kwargs_set = copy(kwargs.get('chunks'))
-        for key, attr_type in model.__annotations__.items():
-            if key == 'pk':
-                continue
-            keys.append(key)
-            for kwarg in kwargs_set:
+        for kwarg in kwargs.get('chunks'):
+            tmp = []
+            for key in keys:
+                attr_type = model.__annotations__[key]
                 value = kwarg.get(key)
                 if attr_type == bool:
                     value = bool(value) and 1 or 0
-                kwarg[key] = value
-
-        for kwarg in kwargs_set:
-            tmp = []
-            for key in keys:
-                tmp.append(kwarg.get(key))
+                else:
+                    value = self._db_value(attr_type, value)
+                tmp.append(value)
             values.append(tmp)
+
+        c = self.conn.cursor()
+        c.executemany(self._statement(model, "insert", (), keys), values)
+        self.mark_written(model.Meta.db_name)
+
+    def update(self, instance, **kwargs):
+        model = instance.__class__
+        set_fields = tuple(key for key in model.__annotations__ if key in kwargs)
+        if not set_fields:
+            return
+        params = [
+            self._db_value(model.__annotations__[key], kwargs[key])
+            for key in set_fields
+        ]
+        params.append(instance.pk)
+
         c = self.conn.cursor()
+        c.execute(self._statement(model, "update", (), set_fields), params)
+        self.mark_written(model.Meta.db_name)
+
+    def update_where(self, model, filter=None, **kwargs):
+        """Set the given values on every row matching filter in one statement."""
+        signature, where_params = self._fetch_attr_clause(model, **(filter or {}))
+        set_fields = tuple(key for key in model.__annotations__ if key in kwargs)
+        if not set_fields:
+            return
+        params = [
+            self._db_value(model.__annotations__[key], kwargs[key])
+            for key in set_fields
+        ]
 
-        c.executemany(
-            "insert into {} ({}) values ({})".format(
-                model.Meta.db_name,
-                ','.join(map(str, keys)),
-                ('?,' * len(keys)).strip(',')
-            ),
-            values
+        c = self.conn.cursor()
+        c.execute(
+            self._statement(model, "update_where", signature, set_fields),
+            params + where_params
         )
-        self.conn.commit()
+        self.mark_written(model.Meta.db_name)
+
+    def update_bulk(self, model, rows):
+        """
+        Apply per-row values, each row being a dict holding its pk.
+
+        Rows setting the same fields share one executemany call.
+        """
+        batches = {}
+        for row in rows:
+            set_fields = tuple(
+                key for key in model.__annotations__ if key != 'pk' and key in row
+            )
+            params = [
+                self._db_value(model.__annotations__[key], row[key])
+                for key in set_fields
+            ]
+            params.append(row['pk'])
+            batches.setdefault(set_fields, []).append(params)
 
-    def update(self, instance, **kwargs):
-        set_clause = self._fetch_attr_clause(instance.__class__, **kwargs)
         c = self.conn.cursor()
-        c.execute("update {} set {} where pk={}".format(
-            instance.Meta.db_name,
-            ', '.join(set_clause),
-            instance.pk
-        ))
-        self.conn.commit()
+        for set_fields, values in batches.items():
+            if set_fields:
+                c.executemany(self._statement(model, "update", (), set_fields), values)
+        self.mark_written(model.Meta.db_name)
+
+    def select_only(self, model, field="selected", **kwargs):
+        """Flag the rows matching kwargs and clear the flag on every other row."""
+        signature, params = self._fetch_attr_clause(model, **kwargs)
+        c = self.conn.cursor()
+        c.execute(self._statement(model, "select_only", signature, (field,)), params)
+        self.mark_written(model.Meta.db_name)
 
     def delete(self, model, **kwargs):
-        where_clause = self._fetch_attr_clause(model, **kwargs)
+        signature, params = self._fetch_attr_clause(model, **kwargs)
         c = self.conn.cursor()
-        c.execute("delete from {} where {}".format(
-            model.Meta.db_name,
-            ' and '.join(where_clause)
-        ))
-        self.conn.commit()
+        c.execute(self._statement(model, "delete", signature), params)
+        self.mark_written(model.Meta.db_name)
 
     def get_size(self):
         c = self.conn.cursor()
@@ -170,4 +582,51 @@ class SQLiteStore:
         return data_set[0]
 
 
-SQLiteDB = SQLiteStore()
+class AsyncSQLiteStore:
+    """
+    Run store work off the Kivy main thread.
+
+    Writes are serialized on one writer thread, reads spread over a small
+    reader pool; each thread talks to SQLite through its own connection.
+    Callbacks receive the result back on the main loop through Clock.
+    """
+
+    def __init__(self, store, readers=2):
+        self.store = store
+        self._writer = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="sqlite-writer"
+        )
+        self._readers = ThreadPoolExecutor(
+            max_workers=readers, thread_name_prefix="sqlite-reader"
+        )
+
+    def read(self, func, *args, callback=None, **kwargs):
+        return self._submit(self._readers, func, args, kwargs, callback)
+
+    def write(self, func, *args, callback=None, **kwargs):
+        return self._submit(self._writer, func, args, kwargs, callback)
+
+    def _submit(self, executor, func, args, kwargs, callback):
+        future = executor.submit(func, *args, **kwargs)
+        if callback is not None:
+            future.add_done_callback(
+                lambda done: Clock.schedule_once(lambda dt: self._deliver(done, callback))
+            )
+        return future
+
+    @staticmethod
+    def _deliver(future, callback):
+        try:
+            result = future.result()
+        except Exception:
+            Logger.exception("Storage: background query failed")
+            return
+        callback(result)
+
+    def shutdown(self):
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+
+
+SQLiteDB = SQLiteStore(journal_mode=JOURNAL_MODE, synchronous=SYNCHRONOUS)
+SQLiteDBAsync = AsyncSQLiteStore(SQLiteDB)
@@ -0,0 +1,180 @@
+import json
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# providers imports kivy and opens the app database under KIVY_HOME.
+os.environ.setdefault("KIVY_NO_ARGS", "1")
+os.environ.setdefault("KIVY_HOME", tempfile.mkdtemp(prefix="kivypraying-test-"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from providers import ProviderError, ResponseCache, Transport  # noqa: E402
+
+PAYLOAD = {"result": [{"saat": "05:00", "vakit": "İmsak"}]}
+ETAG = '"v1"'
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Answers with the server's queued status codes, then with PAYLOAD.
+
+    The ETag is honoured, so a request carrying it gets a 304.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        if server.statuses:
+            status, body = server.statuses.pop(0), b""
+        elif self.headers.get("If-None-Match") == ETAG:
+            status, body = 304, b""
+        else:
+            status, body = 200, server.body
+        self.send_response(status)
+        self.send_header("ETag", ETAG)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StubServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+        self.server.requests = []
+        self.server.statuses = []
+        self.server.body = json.dumps(PAYLOAD).encode("utf-8")
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = "http://127.0.0.1:{}".format(self.server.server_address[1])
+        self.cache = ResponseCache(tempfile.mkdtemp(prefix="kivypraying-cache-"))
+        self.transport = Transport(timeout=(2, 2), backoff=0, cache=self.cache)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.transport.session.close()
+
+    def url(self, path):
+        return self.base_url + path
+
+    def age_cache(self, url, seconds):
+        key = Transport.cache_key(url)
+        entry = self.cache.get(key)
+        entry["stored_at"] -= seconds
+        self.cache.set(key, entry)
+
+
+class TransportTest(StubServerTestCase):
+    def test_revalidates_with_etag_and_replays_304(self):
+        # No TTL for this path, so every call goes back to the server.
+        url = self.url("/uncached")
+        self.assertEqual(self.transport.get_json(url), PAYLOAD)
+        self.assertEqual(self.transport.get_json(url), PAYLOAD)
+
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertNotIn("If-None-Match", self.server.requests[0])
+        self.assertEqual(self.server.requests[1]["If-None-Match"], ETAG)
+
+    def test_fresh_entries_skip_the_network(self):
+        url = self.url("/ulkeler")
+        self.transport.get_json(url)
+        self.transport.get_json(url)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_retries_5xx(self):
+        self.server.statuses = [503, 502]
+        self.assertEqual(self.transport.get_json(self.url("/uncached")), PAYLOAD)
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_exhausted_retries_raise_provider_error(self):
+        self.server.statuses = [503] * 3
+        with self.assertRaises(ProviderError):
+            self.transport.get_json(self.url("/uncached"))
+
+    def test_client_errors_raise_provider_error_without_retry(self):
+        self.server.statuses = [404]
+        with self.assertRaises(ProviderError):
+            self.transport.get_json(self.url("/uncached"))
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_invalid_json_raises_provider_error(self):
+        self.server.body = b"<html>"
+        with self.assertRaises(ProviderError):
+            self.transport.get_json(self.url("/uncached"))
+
+    def test_unreachable_server_raises_provider_error(self):
+        url = self.url("/uncached")
+        self.server.shutdown()
+        self.server.server_close()
+        transport = Transport(timeout=(1, 1), retries=0)
+        with self.assertRaises(ProviderError):
+            transport.get_json(url)
+
+    def test_offline_without_cache_raises_provider_error(self):
+        self.transport.offline = True
+        with self.assertRaises(ProviderError):
+            self.transport.get_json(self.url("/ulkeler"))
+        self.assertEqual(self.server.requests, [])
+
+
+class StaleLimitTest(StubServerTestCase):
+    """Stale entries stand in for failed requests up to their max age."""
+
+    # /pray/all: one hour fresh, served stale for up to a day.
+    PATH = "/pray/all"
+
+    def test_stale_entry_serves_failed_request(self):
+        url = self.url(self.PATH)
+        self.transport.get_json(url)
+        self.age_cache(url, 2 * 3600)
+        self.server.statuses = [503] * 3
+
+        self.assertEqual(self.transport.get_json(url), PAYLOAD)
+        self.assertEqual(len(self.server.requests), 4)
+
+    def test_entry_past_max_stale_is_not_served(self):
+        url = self.url(self.PATH)
+        self.transport.get_json(url)
+        self.age_cache(url, 2 * 24 * 3600)
+        self.server.statuses = [503] * 3
+
+        with self.assertRaises(ProviderError):
+            self.transport.get_json(url)
+
+    def test_offline_serves_stale_entry_within_max_stale(self):
+        url = self.url(self.PATH)
+        self.transport.get_json(url)
+        self.age_cache(url, 2 * 3600)
+        self.transport.offline = True
+
+        self.assertEqual(self.transport.get_json(url), PAYLOAD)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_offline_refuses_entry_past_max_stale(self):
+        url = self.url(self.PATH)
+        self.transport.get_json(url)
+        self.age_cache(url, 2 * 24 * 3600)
+        self.transport.offline = True
+
+        with self.assertRaises(ProviderError):
+            self.transport.get_json(url)
+
+    def test_endpoint_without_limit_serves_any_age(self):
+        url = self.url("/ulkeler")
+        self.transport.get_json(url)
+        self.age_cache(url, 365 * 24 * 3600)
+        self.server.statuses = [503] * 3
+
+        self.assertEqual(self.transport.get_json(url), PAYLOAD)
+
+
+if __name__ == "__main__":
+    unittest.main()